@@ -0,0 +1,116 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Generates synthetic Tampio programs for scaling benchmarks. The program
+# has a chain of rules calling each other, a recursion over a number written
+# as a chain of seuraaja words, and a list literal whose elements are
+# constants. The names are nouns taken from voikko/sanat.txt, so that lexing
+# and inflection see real words. The programs run in both magic and
+# --no-magic mode.
+
+import os, sys, re, random, argparse
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, ROOT_DIR)
+from voikko.inflect_word import inflect_word
+
+# Default values of the parameters
+PARAMETERS = {"rules": 10, "list_size": 10, "depth": 10, "vocabulary": 10}
+
+# Names of the program that are not taken from sanat.txt
+RESERVED = ["tulos", "maailma", "tyhjyys", "nolla", "seuraaja", "yksi", "plus", "lisätty"]
+
+def candidateWords():
+	with open(os.path.join(ROOT_DIR, "std.suomi")) as f:
+		std = set(re.findall(r"\w+", f.read()))
+	words = []
+	with open(os.path.join(ROOT_DIR, "voikko", "sanat.txt")) as f:
+		for line in f:
+			word, classes = line.strip().split(";")
+			# Compound words and proper nouns are skipped
+			if not classes.startswith("subst-") or not re.fullmatch(r"[a-zäö]{4,}", word):
+				continue
+			if word in std or word in RESERVED:
+				continue
+			words.append(word)
+	return sorted(set(words))
+
+def pickWords(count, seed):
+	words = candidateWords()
+	if count > len(words):
+		raise ValueError("sanat.txt has only %d usable nouns" % len(words))
+	chosen = []
+	for word in random.Random(seed).sample(words, len(words)):
+		forms = inflect_word(word)
+		if "genetiivi" in forms and "illatiivi" in forms and forms["nominatiivi"] == word:
+			chosen.append(forms)
+			if len(chosen) == count:
+				break
+	return chosen
+
+def generate(rules=PARAMETERS["rules"], list_size=PARAMETERS["list_size"], depth=PARAMETERS["depth"], vocabulary=PARAMETERS["vocabulary"], seed=0):
+	if rules < 1 or vocabulary < 1:
+		raise ValueError("at least one rule and one word are needed")
+	words = pickWords(rules + vocabulary + 2, seed)
+	functions = words[:rules]
+	constants = words[rules:rules+vocabulary]
+	recursion, lista = words[rules+vocabulary:]
+
+	lines = ["# Generoitu ohjelma: %d sääntöä, %d alkion lista, syvyys %d, %d sanaa" % (rules, list_size, depth, vocabulary), ""]
+
+	# f0(x) = f1(x), f1(x) = f2(x), ..., the last one returns its argument
+	for f, g in zip(functions, functions[1:]):
+		lines.append("x:n %s on x:n %s" % (f["nominatiivi"], g["nominatiivi"]))
+	lines.append("x:n %s on x" % functions[-1]["nominatiivi"])
+	lines.append("")
+
+	lines.append("nollan %s on nolla" % recursion["nominatiivi"])
+	lines.append("x:n seuraajan %s on x:n %s plus yksi" % (recursion["nominatiivi"], recursion["nominatiivi"]))
+	lines.append("")
+
+	for c in constants:
+		lines.append("%s on yksi" % c["nominatiivi"])
+	if list_size == 0:
+		lines.append("%s on tyhjyys" % lista["nominatiivi"])
+	else:
+		elements = [constants[i % vocabulary] for i in range(list_size)]
+		words = [elements[0]["nominatiivi"]] + ["lisättynä " + c["illatiivi"] for c in elements[1:]] + ["lisättynä tyhjyyteen"]
+		lines.append("%s on %s" % (lista["nominatiivi"], " ".join(words)))
+	lines.append("")
+
+	number = " ".join(["nollan"] + ["seuraajan"] * depth)
+	lines.append("tulos on %s %s %s lisättynä %s" % (number, recursion["genetiivi"], functions[0]["nominatiivi"], lista["illatiivi"]))
+	return "\n".join(lines) + "\n"
+
+def main():
+	parser = argparse.ArgumentParser(description='Generates a synthetic Tampio program.')
+	parser.add_argument('--rules', type=int, default=PARAMETERS["rules"], help='length of the chain of rules')
+	parser.add_argument('--list-size', type=int, default=PARAMETERS["list_size"], help='length of the list literal')
+	parser.add_argument('--depth', type=int, default=PARAMETERS["depth"], help='depth of the recursion')
+	parser.add_argument('--vocabulary', type=int, default=PARAMETERS["vocabulary"], help='number of distinct constants in the list')
+	parser.add_argument('--seed', type=int, default=0, help='seed used to choose the words')
+	parser.add_argument('--output', '-o', type=str, help='output file (default: stdout)')
+	args = parser.parse_args()
+	program = generate(args.rules, args.list_size, args.depth, args.vocabulary, args.seed)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(program)
+	else:
+		sys.stdout.write(program)
+
+if __name__ == "__main__":
+	main()
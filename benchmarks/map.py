@@ -0,0 +1,60 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Measures "seuraaja sovellettuna l:n jäseniin" over a list of numbers with
+# and without the native map builtin. When NumPy is installed, the builtin
+# is also measured without vectorization.
+
+import os, sys, time, argparse, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import suomi
+from suomi import CallTree, VarTree, NumTree, ListTree
+
+def mapTree(size):
+	members = CallTree(VarTree("@jäsen"), [ListTree([NumTree(i) for i in range(size)])], "", ("omanto",))
+	return CallTree(VarTree("$sovellettu"), [VarTree("$seuraaja"), members], "olento", ("", "sisatulento"))
+
+def measure(size, builtins, vectorize=False):
+	suomi.vectorize = vectorize
+	suomi.BUILTINS = [bi for bi in BUILTINS if builtins or bi.operator != "$sovellettu"]
+	start = time.perf_counter()
+	suomi.evals(mapTree(size))
+	return time.perf_counter() - start
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks the native map builtin.')
+	parser.add_argument('sizes', type=int, nargs='*', default=[100, 500, 10000, 100000], help='list lengths')
+	parser.add_argument('--max-pure', type=int, default=500, help='longest list evaluated without the builtin')
+	args = parser.parse_args()
+	
+	for size in args.sizes:
+		line = "map over %7d elements: builtin %8.3f s" % (size, measure(size, True))
+		if suomi.numpy is not None:
+			line += ", vectorized %8.3f s" % measure(size, True, True)
+		if size <= args.max_pure:
+			line += ", rules %8.3f s" % measure(size, False)
+		print(line)
+
+suomi.evalFile(suomi.STD_LIB)
+BUILTINS = suomi.BUILTINS
+
+# The rules evaluate the list recursively, one nested call per element
+sys.setrecursionlimit(1000000)
+threading.stack_size(512 * 1024 * 1024)
+thread = threading.Thread(target=main)
+thread.start()
+thread.join()
@@ -0,0 +1,106 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Measures the throughput of lexLine, inflect, inflect_word and
+# voikkoinfl.inflectWord over the lines of std.suomi and the benchmark
+# programs. The analyses of libvoikko are replayed from the fixture
+# benchmarks/voikko-fixture.json, so that the measurements do not depend on
+# libvoikko. The fixture is written again with --record on a machine that has
+# libvoikko and the morphological dictionary, eg. after the corpus or the
+# programs in tests/ change.
+
+import os, sys, time, json, glob, argparse
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARK_DIR)
+FIXTURE = os.path.join(BENCHMARK_DIR, "voikko-fixture.json")
+sys.path.insert(0, ROOT_DIR)
+
+def corpusFiles():
+	return [os.path.join(ROOT_DIR, "std.suomi")] + sorted(glob.glob(os.path.join(BENCHMARK_DIR, "programs", "*.suomi")))
+
+# The programs of tests/test_programs.py are lexed from the fixture too
+def testFiles():
+	return sorted(glob.glob(os.path.join(ROOT_DIR, "tests", "*.suomi")))
+
+# Runs function over all items, repeat times, and returns the fastest time
+def measure(function, items, repeat):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		for item in items:
+			function(*item)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return {"items": len(items), "seconds": best, "per_second": len(items) / best if best else None}
+
+def main():
+	parser = argparse.ArgumentParser(description='Lexer and inflection microbenchmarks.')
+	parser.add_argument('--fixture', type=str, default=FIXTURE, help='recorded voikko analyses')
+	parser.add_argument('--record', action='store_true', help='record the fixture with libvoikko instead of measuring')
+	parser.add_argument('--live', action='store_true', help='use libvoikko instead of the fixture')
+	parser.add_argument('--repeat', type=int, default=10, help='runs per benchmark, the fastest time is reported')
+	parser.add_argument('--output', '-o', type=str, help='write the JSON results to a file instead of stdout')
+	args = parser.parse_args()
+
+	if not args.record and not args.live and not os.path.exists(args.fixture):
+		parser.error("no fixture at %s, record one with --record on a machine with libvoikko or use --live" % args.fixture)
+
+	# The backend is chosen when suomi is imported
+	if args.record:
+		if os.path.exists(args.fixture):
+			os.remove(args.fixture)
+		os.environ["TAMPIO_VOIKKO_RECORD"] = args.fixture
+	elif not args.live:
+		os.environ["TAMPIO_VOIKKO_FIXTURE"] = args.fixture
+	import suomi
+	from voikko import voikkoinfl
+	from voikko.inflect_word import inflect_word, word_and_infl_class, noun_types, WORD_CLASSES
+
+	lines = [line for filename in corpusFiles() for number, line in suomi.readLines(filename)]
+	if args.record:
+		for line in lines + [line for filename in testFiles() for number, line in suomi.readLines(filename)]:
+			suomi.lexLine(line)
+		return
+
+	# The base forms of the nouns in the corpus, inflected in every case
+	words = []
+	for line in lines:
+		for alternatives in suomi.lexLine(line):
+			for word in alternatives:
+				if word.cl == "noun" and word.bf not in words:
+					words.append(word.bf)
+	cases = [case for case in suomi.CASES_LATIN if case != "kerrontosti"]
+	classified = [word for word in words if word in WORD_CLASSES and word_and_infl_class(WORD_CLASSES[word])[0] == "subst"]
+
+	results = {
+		"lexLine": measure(suomi.lexLine, [(line,) for line in lines], args.repeat),
+		"inflect": measure(suomi.inflect, [("$" + word, case) for word in words for case in cases], args.repeat),
+		"inflect_word": measure(inflect_word, [(word,) for word in words], args.repeat),
+		"inflectWord": measure(voikkoinfl.inflectWord, [(word, word_and_infl_class(WORD_CLASSES[word])[1], noun_types) for word in classified], args.repeat),
+	}
+	for name, result in results.items():
+		sys.stderr.write("%-14s %7d items %9.4f s %12.1f items/s\n" % (name, result["items"], result["seconds"], result["per_second"]))
+
+	report = {"backend": "libvoikko" if args.live else "fixture", "repeat": args.repeat, "results": results}
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2)
+	else:
+		print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+	main()
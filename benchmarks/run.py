@@ -0,0 +1,201 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Runs the programs in benchmarks/programs in magic and --no-magic mode and
+# reports lexing, parsing, evaluation and printing times and allocations,
+# rewrite counts and peak memory as JSON. Every measurement is made in a fresh interpreter
+# process so that the runs do not share caches or memory.
+
+import os, sys, time, json, argparse, platform, subprocess, contextlib, threading, tracemalloc
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+PROGRAM_DIR = os.path.join(BENCHMARK_DIR, "programs")
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+MODES = ["magic", "no-magic"]
+
+# The IO builtins are disabled in --no-magic mode, so IO programs are run with magic only
+IO_PROGRAMS = ["io.suomi"]
+
+TIMES = ["lex", "parse", "define", "eval", "print"]
+
+def peakMemory():
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports kilobytes, macOS bytes
+	return peak // 1024 if sys.platform == "darwin" else peak
+
+# Adds the time spent in the block to report["times"][key]. When memory is
+# traced, also records the largest allocation peak of the block.
+@contextlib.contextmanager
+def phase(report, key):
+	if tracemalloc.is_tracing():
+		base = tracemalloc.get_traced_memory()[0]
+		tracemalloc.reset_peak()
+	start = time.perf_counter()
+	yield
+	report["times"][key] += time.perf_counter() - start
+	if tracemalloc.is_tracing():
+		report["memory"][key] = max(report["memory"][key], tracemalloc.get_traced_memory()[1] - base)
+
+# An instrumented run counts the rewrites and traces memory allocations,
+# which makes it too slow for timing
+def measure(program, mode, instrument):
+	import suomi
+
+	class Counter(suomi.Tracer):
+		def __init__(self):
+			self.counts = {"rewrites": 0, "optimizations": 0, "builtins": 0}
+		def rewrite(self, tree, defi, result):
+			self.counts["rewrites"] += 1
+		def optimization(self, tree, opt):
+			self.counts["optimizations"] += 1
+		def builtin(self, tree, bi):
+			self.counts["builtins"] += 1
+
+	suomi.magic = mode == "magic"
+	suomi.vectorize = suomi.vectorize and suomi.magic
+	suomi.evalFile(suomi.STD_LIB)
+
+	report = {"version": suomi.VERSION_STRING, "times": dict.fromkeys(TIMES, 0.0)}
+	if instrument:
+		counter = Counter()
+		suomi.addTracer(counter)
+		report["memory"] = dict.fromkeys(TIMES, 0)
+		tracemalloc.start()
+
+	# Programs given by path are used as is
+	filename = os.path.join(PROGRAM_DIR, program)
+	for number, line in suomi.readLines(filename):
+		with phase(report, "lex"):
+			output = suomi.lexLine(line)
+		with phase(report, "parse"):
+			eqs = suomi.parseWhen(suomi.TokenStream(output)) if output else []
+		with phase(report, "define"):
+			for eq in eqs:
+				if eq.op == "#olla":
+					suomi.addDefinition(eq, suomi.sourceLocation(filename, number))
+
+	# IO programs print as they run
+	with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+		with phase(report, "eval"):
+			result = suomi.evals(suomi.resultTree(os.path.basename(program) in IO_PROGRAMS))
+		with phase(report, "print"):
+			report["result"] = result.inflect("nimento")
+
+	report["peak_memory_kb"] = peakMemory()
+	if instrument:
+		report["counts"] = counter.counts
+	return report
+
+def measureInThread(program, mode, instrument):
+	reports = []
+	# Deep terms are evaluated and printed recursively
+	sys.setrecursionlimit(1000000)
+	threading.stack_size(512 * 1024 * 1024)
+	thread = threading.Thread(target=lambda: reports.append(measure(program, mode, instrument)))
+	thread.start()
+	thread.join()
+	if not reports:
+		sys.exit(1)
+	return reports[0]
+
+def runChild(program, mode, instrument):
+	command = [sys.executable, os.path.realpath(__file__), "--child", program, mode]
+	if instrument:
+		command.append("--instrument")
+	process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+	if process.returncode != 0:
+		sys.stderr.write(process.stderr)
+		raise RuntimeError("%s (%s) failed with exit code %d" % (program, mode, process.returncode))
+	return json.loads(process.stdout.strip().splitlines()[-1])
+
+def runBenchmark(program, mode, repeat):
+	reports = [runChild(program, mode, False) for _ in range(repeat)]
+	instrumented = runChild(program, mode, True)
+	if instrumented["result"] != reports[0]["result"]:
+		raise RuntimeError("%s (%s) gave different results in different runs" % (program, mode))
+	return {
+		"program": program,
+		"mode": mode,
+		"result": reports[0]["result"],
+		"times": {key: min([report["times"][key] for report in reports]) for key in TIMES},
+		"counts": instrumented["counts"],
+		"memory": instrumented["memory"],
+		"peak_memory_kb": reports[0]["peak_memory_kb"],
+	}, reports[0]["version"]
+
+def printTable(results, previous, out):
+	old = {(result["program"], result["mode"]): result for result in previous["results"]} if previous else {}
+	out.write("%-18s %-9s" % ("program", "mode") + "".join(["%10s" % key for key in TIMES]) + "%10s %10s\n" % ("rewrites", "memory kB"))
+	for result in results:
+		line = "%-18s %-9s" % (result["program"], result["mode"])
+		line += "".join(["%10.4f" % result["times"][key] for key in TIMES])
+		line += "%10d %10s" % (result["counts"]["rewrites"], result["peak_memory_kb"])
+		key = (result["program"], result["mode"])
+		if key in old and old[key]["times"]["eval"] > 0:
+			line += "   eval %.2fx" % (result["times"]["eval"] / old[key]["times"]["eval"])
+		out.write(line + "\n")
+
+def main():
+	parser = argparse.ArgumentParser(description='Runs the Tampio benchmark programs.')
+	parser.add_argument('programs', type=str, nargs='*', help='programs in benchmarks/programs (default: all)')
+	parser.add_argument('--mode', choices=MODES, action='append', help='run only in the given mode')
+	parser.add_argument('--repeat', type=int, default=3, help='runs per program, the fastest times are reported')
+	parser.add_argument('--output', '-o', type=str, help='write the JSON results to a file instead of stdout')
+	parser.add_argument('--compare', type=str, help='JSON results of an earlier run to compare evaluation times with')
+	parser.add_argument('--child', nargs=2, metavar=('PROGRAM', 'MODE'), help=argparse.SUPPRESS)
+	parser.add_argument('--instrument', action='store_true', help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.child:
+		print(json.dumps(measureInThread(args.child[0], args.child[1], args.instrument)))
+		return
+
+	programs = args.programs or sorted([name for name in os.listdir(PROGRAM_DIR) if name.endswith(".suomi")])
+	results = []
+	version = None
+	for program in programs:
+		for mode in args.mode or MODES:
+			if mode != "magic" and program in IO_PROGRAMS:
+				continue
+			result, version = runBenchmark(program, mode, args.repeat)
+			results.append(result)
+
+	report = {
+		"interpreter": version,
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		"repeat": args.repeat,
+		"results": results,
+	}
+	previous = None
+	if args.compare:
+		with open(args.compare) as f:
+			previous = json.load(f)
+	printTable(results, previous, sys.stderr)
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2, ensure_ascii=False)
+	else:
+		print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+	main()
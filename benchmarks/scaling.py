@@ -0,0 +1,108 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Varies one parameter of the generated programs at a time, keeping the
+# others at their default values, and reports how the times and allocations
+# of lexing, parsing, evaluation and printing grow. If matplotlib is
+# installed, the results can also be drawn as plots.
+
+import os, sys, json, argparse, tempfile
+
+import generate, run
+
+try:
+	import matplotlib
+	matplotlib.use("Agg")
+	import matplotlib.pyplot as pyplot
+except ImportError:
+	pyplot = None
+
+VALUES = {
+	"rules": [1, 50, 100, 200, 400],
+	"list_size": [1, 50, 100, 200, 400],
+	"depth": [1, 10, 20, 40, 80],
+	"vocabulary": [1, 25, 50, 100, 200],
+}
+
+PHASES = ["lex", "parse", "eval", "print"]
+
+def sweep(parameter, values, modes, repeat, directory):
+	results = []
+	for value in values:
+		parameters = dict(generate.PARAMETERS)
+		parameters[parameter] = value
+		filename = os.path.join(directory, "%s-%d.suomi" % (parameter, value))
+		with open(filename, "w") as f:
+			f.write(generate.generate(**parameters))
+		for mode in modes:
+			result, version = run.runBenchmark(filename, mode, repeat)
+			del result["program"]
+			result["value"] = value
+			results.append(result)
+			sys.stderr.write("%-10s %6d %-9s" % (parameter, value, mode))
+			sys.stderr.write("".join(["%10.4f s %8d kB" % (result["times"][key], result["memory"][key] // 1024) for key in PHASES]) + "\n")
+	return results
+
+def plot(parameter, results, modes, directory):
+	figure, (times, memory) = pyplot.subplots(1, 2, figsize=(12, 5))
+	for mode in modes:
+		rows = [result for result in results if result["mode"] == mode]
+		values = [result["value"] for result in rows]
+		for key in PHASES:
+			times.plot(values, [result["times"][key] for result in rows], marker="o", label="%s (%s)" % (key, mode))
+			memory.plot(values, [result["memory"][key] / 1024 for result in rows], marker="o", label="%s (%s)" % (key, mode))
+	times.set_xlabel(parameter)
+	times.set_ylabel("time (s)")
+	memory.set_xlabel(parameter)
+	memory.set_ylabel("allocated (kB)")
+	times.legend()
+	figure.tight_layout()
+	figure.savefig(os.path.join(directory, parameter + ".png"))
+	pyplot.close(figure)
+
+def main():
+	parser = argparse.ArgumentParser(description='Measures how the interpreter scales with the size of generated programs.')
+	parser.add_argument('parameters', type=str, nargs='*', help='parameters to vary: %s (default: all)' % ", ".join(VALUES))
+	parser.add_argument('--values', type=str, help='comma-separated values of the parameter instead of the defaults')
+	parser.add_argument('--mode', choices=run.MODES, action='append', help='run only in the given mode')
+	parser.add_argument('--repeat', type=int, default=1, help='runs per program, the fastest times are reported')
+	parser.add_argument('--output', '-o', type=str, help='write the JSON results to a file instead of stdout')
+	parser.add_argument('--plot', type=str, metavar='DIR', help='draw a plot of each parameter to DIR (needs matplotlib)')
+	args = parser.parse_args()
+
+	for parameter in args.parameters:
+		if parameter not in VALUES:
+			parser.error("unknown parameter: " + parameter)
+	if args.plot and pyplot is None:
+		parser.error("--plot needs matplotlib")
+	modes = args.mode or run.MODES
+	report = {}
+	with tempfile.TemporaryDirectory() as directory:
+		for parameter in args.parameters or list(VALUES):
+			values = [int(value) for value in args.values.split(",")] if args.values else VALUES[parameter]
+			report[parameter] = sweep(parameter, values, modes, args.repeat, directory)
+			if args.plot:
+				os.makedirs(args.plot, exist_ok=True)
+				plot(parameter, report[parameter], modes, args.plot)
+
+	if args.output:
+		with open(args.output, "w") as f:
+			json.dump(report, f, indent=2, ensure_ascii=False)
+	else:
+		print(json.dumps(report, indent=2, ensure_ascii=False))
+
+if __name__ == "__main__":
+	main()
@@ -14,14 +14,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import os, sys, traceback, argparse, operator, re, readline, atexit
+import os, sys, traceback, argparse, operator, re, readline, atexit, multiprocessing, time, json, collections, signal, hashlib, gzip, tempfile
 from voikko.libvoikko import Voikko, Token
+from voikko.recorded import RecordingVoikko, RecordedVoikko
+try:
+	import numpy
+except ImportError:
+	numpy = None
 from voikko.inflect_word import inflect_word
 
 LANGUAGE = "fi-x-morpho"
 ENCODING = "UTF-8"
 
-voikko = Voikko(LANGUAGE)
+# TAMPIO_VOIKKO_RECORD saves the analyses of libvoikko to a fixture file and
+# TAMPIO_VOIKKO_FIXTURE replays them without libvoikko
+if os.environ.get("TAMPIO_VOIKKO_FIXTURE"):
+	voikko = RecordedVoikko(LANGUAGE, os.environ["TAMPIO_VOIKKO_FIXTURE"])
+elif os.environ.get("TAMPIO_VOIKKO_RECORD"):
+	voikko = RecordingVoikko(Voikko(LANGUAGE), LANGUAGE, os.environ["TAMPIO_VOIKKO_RECORD"])
+else:
+	voikko = Voikko(LANGUAGE)
 
 CASES_LATIN = {
 	"nimento": "nominatiivi",
@@ -166,13 +178,26 @@ CASE_REGEXES = {
 	}
 }
 
-def inflect(word, case):
+# Names are inflected as numbers, single letters or words. The class of a
+# name is computed when its VarTree is created.
+def inflectionClass(name):
+	word = name[1:]
+	if word.isascii() and word.isdigit():
+		return "number"
+	elif len(word) == 1:
+		return "letter"
+	else:
+		return "word"
+
+def inflect(word, case, cl=None):
+	if cl is None:
+		cl = inflectionClass(word)
 	case_latin = CASES_LATIN[case]
 	if word[0] == "@":
 		case_latin += "_mon"
 	word = word[1:]
 	
-	if re.fullmatch(r"[0-9]+", word):
+	if cl == "number":
 		if case == "sisatulento":
 			if word[-1] in "123560":
 				return word + ":een"
@@ -184,7 +209,7 @@ def inflect(word, case):
 			return word + CASES_A[case].replace("a", "ä")
 		else:
 			return word + CASES_A[case]
-	elif len(word) == 1:
+	elif cl == "letter":
 		if word in "flmnrsx":
 			return word + CASES_F[case]
 		elif case == "sisatulento":
@@ -282,12 +307,28 @@ class Conj:
 	def str(self, nocase=False):
 		return "&" + self.bf
 
+# An immutable array of lexed words with a cursor. The preferred alternative
+# of each word is chosen once, and backtracking only restores the cursor.
+class TokenStream:
+	def __init__(self, output):
+		self.words = tuple(as2w(alternatives) for alternatives in output)
+		self.strs = tuple(w.str() for w in self.words)
+		self.pos = 0
+	def __len__(self):
+		return len(self.words) - self.pos
+	def peek(self):
+		return self.words[self.pos]
+	def peekStr(self):
+		return self.strs[self.pos]
+	def skip(self):
+		self.pos += 1
+
 def nextWord(words):
 	if len(words) == 0:
 		fatalError("Syntax error: unexpected eof")
-	w = words[0]
-	del words[0]
-	return as2w(w)
+	w = words.peek()
+	words.skip()
+	return w
 
 PROMOTE = [
 	"yksi",
@@ -299,9 +340,9 @@ def as2w(w):
 
 def isNext(words, s):
 	if isinstance(s, list):
-		return len(words) > 0 and as2w(words[0]).str() in s
+		return len(words) > 0 and words.peekStr() in s
 	else:
-		return len(words) > 0 and as2w(words[0]).str() == s
+		return len(words) > 0 and words.peekStr() == s
 
 def checkCase(got, expected, place):
 	if got != expected:
@@ -314,6 +355,12 @@ class EqTree:
 		self.left = left
 		self.right = right
 		self.where = where
+		self.source = None
+		# The variables that occur several times in the bodies
+		self.thawed = frozenset()
+		# The number of times the rule has fired, and its compiled version
+		self.firings = 0
+		self.compiled = None
 	def str(self):
 		if self.query():
 			return self.left.str()
@@ -343,7 +390,7 @@ def parseWhen(words):
 	eqs = []
 	variables = []
 	while isNext(words, "&kun"):
-		del words[0]
+		words.skip()
 		eqCounter += 1
 		
 		when = parseEq(words, False)
@@ -387,7 +434,7 @@ def parseEq(words, allowQueries):
 	
 	always = True
 	if isNext(words, ".epäpuhdas:D"):
-		del words[0]
+		words.skip()
 		always = False
 	
 	c, right = parsePattern(words)
@@ -395,7 +442,7 @@ def parseEq(words, allowQueries):
 	
 	where = []
 	if isNext(words, "?mikä:S_"):
-		del words[0]
+		words.skip()
 		
 		var = nextWord(words)
 		if var.cl != "noun":
@@ -415,8 +462,11 @@ def parseEq(words, allowQueries):
 	
 	return EqTree(w.str(), always, left, right, where)
 
+def isNumeral(word):
+	return word.isascii() and word.isdigit() and (word == "0" or word[0] != "0")
+
 def parseVar(name):
-	if magic and re.fullmatch(r"\$([1-9][0-9]*|0)", name):
+	if magic and name[0] == "$" and isNumeral(name[1:]):
 		return NumTree(int(name[1:]))
 	elif magic and name == "$nolla":
 		return NumTree(0)
@@ -442,6 +492,10 @@ class VarTree(AtomicTree):
 		super().__init__()
 		self.name = name
 		self.alias = alias
+		# Two-letter names like $x are pattern variables
+		self.pattern = len(name) == 2 and name[1] not in "0123456789"
+		self.cl = inflectionClass(name)
+		self.aliasClass = None if alias is None else inflectionClass(alias)
 	def __eq__(self, tree):
 		return type(tree) == VarTree and self.name == tree.name
 	def __hash__(self):
@@ -451,7 +505,7 @@ class VarTree(AtomicTree):
 	def str(self, objects=None):
 		return self.name
 	def match(self, tree):
-		if re.fullmatch(r".[^0-9]", self.name):
+		if self.pattern:
 			return True, {self.name: tree}
 		if isinstance(tree, VarTree):
 			return self.name == tree.name, {}
@@ -462,9 +516,9 @@ class VarTree(AtomicTree):
 		return False, {}
 	def inflect(self, case, objects=None):
 		if self.alias is not None:
-			return '"' + inflect(self.alias, case) + '"'
+			return '"' + inflect(self.alias, case, self.aliasClass) + '"'
 		else:
-			return inflect(self.name, case)
+			return inflect(self.name, case, self.cl)
 	def subs(self, subs, objects=None):
 		if self.name in subs:
 			return subs[self.name]
@@ -496,9 +550,15 @@ class NumTree(AtomicTree):
 		return False, {}
 	def inflect(self, case, objects=None):
 		if self.num == 0:
-			return inflect("$nolla", case)
+			return inflect("$nolla", case, "word")
+		elif self.num < 0:
+			# negative numbers are printed as the standard library represents them
+			return CallTree(VarTree("$negatiivinen"), [NumTree(-self.num)], "olento", ("",)).inflect(case)
 		else:
-			return '"' + inflect("$" + str(self.num), case) + '"'
+			return '"' + inflect("$" + str(self.num), case, "number") + '"'
+	def shouldReverseOrder(self):
+		# negative numbers are printed as calls in the essive case
+		return self.num >= 0
 
 class WorldTree(AtomicTree):
 	def __init__(self, counter):
@@ -514,9 +574,79 @@ class WorldTree(AtomicTree):
 	def str(self, objects=None):
 		return "$maailma(" + str(self.counter) + ")"
 	def inflect(self, case, objects=None):
-		return '"' + inflect("$maailma", case) + '"'
+		return '"' + inflect("$maailma", case, "word") + '"'
+
+# A list whose spine is fully evaluated, stored as a view (start and end
+# indices) of a Python list of elements. The elements themselves may be
+# unevaluated, and like the arguments of a CallTree, they are replaced in
+# place when evaluated. ListTrees are created only in the magic mode, from
+# list literals in definitions and by the list builtins. They are never empty;
+# an empty list is represented by tyhjyys.
+class ListTree(AtomicTree):
+	def __init__(self, items, start=0, end=None):
+		super().__init__()
+		self.items = items
+		self.start = start
+		self.end = len(items) if end is None else end
+	def __len__(self):
+		return self.end - self.start
+	def __eq__(self, tree):
+		return type(tree) == ListTree and self.elements() == tree.elements()
+	def elements(self):
+		return self.items[self.start:self.end]
+	def get(self, i):
+		return self.items[self.start + i]
+	def slice(self, start, end):
+		if start >= end:
+			return VarTree("$tyhjyys")
+		return ListTree(self.items, self.start + start, self.start + end)
+	def uncons(self):
+		return CallTree(VarTree("$lisätty"), [self.get(0), self.slice(1, len(self))], "olento", ("", "sisatulento"))
+	def safeEq(self, tree, objects=[]):
+		return (isinstance(tree, ListTree) and len(self) == len(tree)
+			and all([a.safeEq(b, objects) for a, b in zip(self.elements(), tree.elements())]))
+	def copy(self, objects=[]):
+		return ListTree([e.copy(objects) for e in self.elements()])
+	def subs(self, subs, objects=[]):
+		return ListTree([e.subs(subs, objects) for e in self.elements()])
+	def str(self, objects=[]):
+		return "$lista[" + ", ".join([e.str(objects) for e in self.elements()]) + "]"
+	def inflect(self, case, objects=[]):
+		return inflectList(self.elements(), VarTree("$tyhjyys"), case, objects)
+	def match(self, tree):
+		return False, {}
+	def shouldReverseOrder(self):
+		return False
+	def containsFunctions(self):
+		return False
+
+# A fully evaluated list of numbers stored as a NumPy array (int64, or object
+# if the numbers do not fit). Created by the vectorized list builtins.
+class NumListTree(ListTree):
+	def elements(self):
+		return [NumTree(int(n)) for n in self.items[self.start:self.end]]
+	def get(self, i):
+		return NumTree(int(self.items[self.start + i]))
+	def array(self):
+		return self.items[self.start:self.end]
+	def slice(self, start, end):
+		if start >= end:
+			return VarTree("$tyhjyys")
+		return NumListTree(self.items, self.start + start, self.start + end)
+	def copy(self, objects=[]):
+		return NumListTree(self.array().copy())
+	def subs(self, subs, objects=[]):
+		return self
+
+def inflectList(elements, tail, case, objects):
+	tailString = "" if isinstance(tail, VarTree) and tail.str() == "$tyhjyys" else " ++ " + tail.inflect("nimento", objects)
+	return '"%s" [%s]%s' % (
+		inflect("$lista", case, "word"),
+		", ".join([e.inflect("nimento", objects) for e in elements]),
+		tailString)
 
 class CallTree:
+	variables = None
 	def __init__(self, head, args, headInfl, argInfls):
 		self.head = head
 		self.args = args
@@ -535,7 +665,7 @@ class CallTree:
 		for obj in objects:
 			if obj is self:
 				return True
-		objects += [self]
+		objects = objects + [self]
 		return (len(self.args) == len(tree.args)
 			and self.headInfl == tree.headInfl
 			and self.argInfls == tree.argInfls
@@ -553,7 +683,7 @@ class CallTree:
 	def headIs(self, tree, headInfl, argInfls):
 		inflOk = self.headInfl == headInfl and self.argInfls == argInfls
 		if isinstance(tree, str):
-			return isinstance(self.head, VarTree) and self.head.name == tree
+			return isinstance(self.head, VarTree) and self.head.name == tree and inflOk
 		else:
 			return self.head == tree and inflOk
 	def getHead(self):
@@ -589,8 +719,16 @@ class CallTree:
 		if isinstance(tree, NumTree) and tree.num > 0:
 			if self.headIs("$seuraaja", "", ("omanto",)):
 				return self.args[0].match(NumTree(tree.num - 1))
+		if isinstance(tree, NumTree) and tree.num < 0:
+			if self.headIs("$negatiivinen", "olento", ("",)):
+				return self.args[0].match(NumTree(-tree.num))
+		if isinstance(tree, ListTree):
+			if self.headIs("$lisätty", "olento", ("", "sisatulento")):
+				return self.match(tree.uncons())
 		return False, {}
 	def subs(self, subs, objects=[]):
+		if self.variables is not None and self.variables.isdisjoint(subs):
+			return self
 		for obj, copy in objects:
 			if obj is self:
 				return copy
@@ -615,11 +753,10 @@ class CallTree:
 			while isinstance(tail, CallTree) and tail.headIs("$lisätty", "olento", ("", "sisatulento")):
 				elements += [tail.args[0]]
 				tail = tail.args[1]
-			tailString = "" if isinstance(tail, VarTree) and tail.str() == "$tyhjyys" else " ++ " + tail.inflect("nimento", objects)
-			return '"%s" [%s]%s' % (
-				inflect("$lista", case),
-				", ".join([e.inflect("nimento", objects) for e in elements]),
-				tailString)
+			if isinstance(tail, ListTree):
+				elements += tail.elements()
+				tail = VarTree("$tyhjyys")
+			return inflectList(elements, tail, case, objects)
 		if self.headInfl == "olento":
 			# TODO: entä jos tulevaisuudessa olisikin enemmän argumentteja???
 			if case != "omanto" and len(self.args) == 2 and self.args[1].shouldReverseOrder():
@@ -647,9 +784,9 @@ CONJUNCTIONS = ["&ja", "&sekä", "&tai"]
 def parsePattern(words):
 	case, root = parseUnary(words)
 	while len(words) != 0:
-		w = as2w(words[0])
-		if w.str() in (CONJUNCTIONS + BINARY_OPERATORS_CASE):
-			del words[0]
+		w = words.peek()
+		if words.peekStr() in (CONJUNCTIONS + BINARY_OPERATORS_CASE):
+			words.skip()
 			
 			case2, arg = parseUnary(words)
 			if w.str() in CONJUNCTIONS:
@@ -673,9 +810,9 @@ def parseUnary(words, allowReverseWordOrder=True):
 	if not isinstance(w, Noun):
 		fatalError("Syntax error: expected noun, got " + w.str())
 	if w.case != "nimento" and w.case != "omanto" and isNext(words, CONJUNCTIONS):
-		words2 = words[:]
-		conj = as2w(words[0]).str()
-		del words[0]
+		pos = words.pos
+		conj = words.peekStr()
+		words.skip()
 		#if w.case == "omanto":
 			# ... TODO
 		#else:
@@ -683,20 +820,19 @@ def parseUnary(words, allowReverseWordOrder=True):
 		if case == w.case:
 			root = CallTree(parseVar(conj), [root, arg], "", ("", ""))
 		else:
-			del words[:]
-			words += words2
+			words.pos = pos
 	else:
 		root = parseEssive(root, words, allowReverseWordOrder)
 	return w.case, root
 
 def parseEssive(root, words, allowReverseWordOrder, allowFullPattern=True):
 	while len(words) != 0:
-		w = as2w(words[0])
+		w = words.peek()
 		if w.cl == "noun":
 			owners = []
 			if allowFullPattern:
-				words2 = words[:]
-				del words[0]
+				pos = words.pos
+				words.skip()
 				while w.case == "omanto":
 					owners += [w]
 					w = nextWord(words)
@@ -705,12 +841,11 @@ def parseEssive(root, words, allowReverseWordOrder, allowFullPattern=True):
 				args = []
 				argInfls = []
 				if len(words) != 0:
-					if as2w(words[0]).cl == "noun":
-						words3 = words[:]
+					if words.peek().cl == "noun":
+						pos3 = words.pos
 						case, arg = parseUnary(words, False)
 						if case in ["nimento", "omanto", "olento"]:
-							del words[:]
-							words += words3
+							words.pos = pos3
 						else:
 							args += [arg]
 							argInfls += [case]
@@ -733,8 +868,7 @@ def parseEssive(root, words, allowReverseWordOrder, allowFullPattern=True):
 				
 				root = CallTree(root2, [root, arg], "olento", ("", case))
 			elif allowFullPattern:
-				del words[:]
-				words += words2
+				words.pos = pos
 				return root
 		else:
 			break
@@ -757,6 +891,8 @@ stack = []
 
 def fatalError(msg):
 	sys.stderr.write(msg + "\n")
+	if TRACERS:
+		trace("stop")
 	raise(StopEvaluation())
 
 class StopEvaluation(Exception):
@@ -771,61 +907,149 @@ def printStack():
 		sys.stderr.write("Defs:\n")
 		for defi in DEFS:
 			sys.stderr.write("  " + defi.str() + "\n")
+	if TRACERS:
+		trace("stop")
 	raise(StopEvaluation())
 
-# Fully evaluates an expression
+# Fully evaluates an expression. A step that rewrites nothing to a different
+# tree leaves the expression unchanged, so the loop stops when a step does not
+# set the changed flag.
 def evals(tree):
-	a = evals_(tree)
-	c = a.copy()
+	global changed
+	if STRICT is None:
+		analyzeStrictness()
+		if TABLES and not freeMode:
+			checkTables()
+	a = tree
 	while True:
-		if visualize:
-			print(a.inflect("nimento"))
-		b = evals_(a)
-		if c.safeEq(b):
+		changed = False
+		a = evals_(a)
+		if not changed:
 			break
-		a = b
-		c = a.copy()
-	if debug and verbosity >= 1:
-		print("\x1b[1;4;31mEnd:\x1b[0m " + a.str())
+		if TRACERS:
+			trace("step", a)
+	if TRACERS:
+		trace("end", a)
 	return a
 
+changed = False
+
+# Records whether a rewrite of tree produced a different tree
+def rewritten(tree, result):
+	global changed
+	if not changed and not result.safeEq(tree):
+		changed = True
+	return result
+
 # Evaluates an expression lazily (ie. evaluates the uppermost calls, but not arguments)
-def evals_(tree, objects=[]):
+#
+# The uppermost call is trampolined: when it is rewritten to a new tree, the
+# next evals step would start by matching that tree again, so it is matched
+# here in a loop instead of returning to evals. Arguments are still evaluated
+# only one step at a time, as rewriting them further could change the rule
+# that matches the call around them. A rewrite that returns an equal tree
+# would loop forever, so the trees are compared after 1, 2, 4, 8... steps.
+# The followed copies of constants are not trampolined, so that each of their
+# forms is seen by evalsConstant.
+def evals_(tree, objects=[], trampoline=True):
+	if pendingConstants and id(tree) in pendingConstants:
+		return evalsConstant(tree, objects)
 	for obj in objects:
 		if obj is tree:
 			return tree
+	root = not objects
+	trampoline = trampoline and root
 	objects = objects + [tree]
-	global stack
+	global stack, changed
 	stack += [tree]
+	if TRACERS:
+		trace("enter", tree)
 	try:
-		if magic:
-			for opt in OPTIMIZATIONS:
-				if opt.match(tree):
-					if debug and verbosity >= 1:
-						print(" "*len(stack) + "\x1b[1;4;31mMatch:\x1b[0m " + tree.str() + " \x1b[1;33m(opt)\x1b[0m")
-					return opt.optimize(tree)
-			for bi in BUILTINS:
-				if bi.match(tree):
-					if debug and verbosity >= 1:
-						print(" "*len(stack) + "\x1b[1;4;31mMatch:\x1b[0m " + tree.str() + " \x1b[1;33m(builtin)\x1b[0m")
-					return bi.eval(tree)
-		for defi in DEFS:
-			ok, subs = defi.left.match(tree)
-			if ok:
-				for var, body in defi.where[::-1]:
-					if var in subs:
-						sys.stderr.write("Error: Illegal redefinition of " + var + "\n")
-						raise(StopEvaluation())
-					subs[var] = body.subs(subs)
-				rightsubs = defi.right.subs(subs) if len(subs) > 0 or (defi.always and (impure or not freeMode)) else defi.right
-				if debug and verbosity >= 1:
-					print(" "*len(stack) + "\x1b[1;4;31mMatch:\x1b[0m " + tree.str() + " \x1b[1;4;34m==\x1b[0m " + defi.left.str() + " \x1b[1;4;34m->\x1b[0m " + rightsubs.str())
-				return rightsubs
-			elif debug and verbosity >= 2:
-				print(" "*len(stack) + "\x1b[1;4;31mNO MATCH:\x1b[0m " + tree.str() + " \x1b[1;4;34m!=\x1b[0m " + defi.left.str() + " \x1b[1;33m(def)\x1b[0m")
-		if isinstance(tree, CallTree):
+		original = tree
+		steps = 0
+		while True:
+			if STRICT and isinstance(tree, CallTree) and awaitsArgument(tree):
+				# The maps and slices of a fused map are not evaluated first
+				if magic and LIST_FUSION.match(tree):
+					if TRACERS:
+						trace("builtin", tree, LIST_FUSION)
+					return rewritten(tree, LIST_FUSION.eval(tree))
+				break
+			if TABLES and not freeMode and id(tree) not in tabling and isTabled(tree):
+				if all([isValue(arg) and isNormal(arg) for arg in tree.args]):
+					return rewritten(tree, evalsTabled(tree))
+			if magic:
+				for opt in OPTIMIZATIONS:
+					if opt.match(tree):
+						if TRACERS:
+							trace("optimization", tree, opt)
+						return rewritten(tree, opt.optimize(tree))
+				for bi in BUILTINS:
+					if bi.match(tree):
+						if TRACERS:
+							trace("builtin", tree, bi)
+						return rewritten(tree, bi.eval(tree))
+			for index, defi in enumerate(DEFS):
+				compiled = defi.compiled
+				ok, subs = defi.left.match(tree) if compiled is None else compiled.match(tree)
+				if ok:
+					# A variable may occur several times in the body, and all occurrences should see its evaluation
+					for var in defi.thawed:
+						if var in subs:
+							subs[var] = thaw(subs[var])
+					for var, body in defi.where[::-1]:
+						if var in subs:
+							fatalError("Error: Illegal redefinition of " + var)
+						subs[var] = body.subs(subs)
+						if var in defi.thawed:
+							subs[var] = thaw(subs[var])
+					if defi in CONSTANTS and (root or CONSTANTS[defi][1]):
+						rightsubs = CONSTANTS[defi][0]
+					else:
+						if len(subs) > 0 or (defi.always and (impure or not freeMode)):
+							rightsubs = defi.right.subs(subs) if compiled is None else compiled.build(subs)
+						else:
+							rightsubs = defi.right
+						if isinstance(defi.left, VarTree) and defi.always and not freeMode and defi not in trackedConstants and defi not in CONSTANTS:
+							trackConstant(defi, rightsubs)
+					if jit and compiled is None:
+						defi.firings += 1
+						if defi.firings >= JIT_THRESHOLD:
+							compileRule(defi)
+					if TRACERS:
+						trace("scanned", tree, index)
+						trace("rewrite", tree, defi, rightsubs)
+					break
+				elif tracingAttempts:
+					trace("attempt", tree, defi)
+			else:
+				if TRACERS:
+					trace("scanned", tree, len(DEFS))
+				break
+			# A followed constant must be seen by evals_ at every step
+			if not trampoline or not isinstance(rightsubs, CallTree) or id(rightsubs) in pendingConstants:
+				return rewritten(tree, rightsubs)
+			steps += 1
+			if steps & (steps - 1) == 0 and rightsubs.safeEq(tree):
+				return rewritten(original, rightsubs)
+			changed = True
+			tree = stack[-1] = objects[-1] = rightsubs
+			if TRACERS:
+				trace("step", tree)
+		# The calls of rule bodies are shared, so they are copied instead of changed
+		if isinstance(tree, CallTree) and tree.variables is not None:
+			head = evals_(tree.head, objects)
+			args = [evals_(arg, objects) for arg in tree.args]
+			if head is not tree.head or any([arg is not old for arg, old in zip(args, tree.args)]):
+				tree = CallTree(None, None, tree.headInfl, tree.argInfls)
+				tree.head = head
+				tree.args = args
+		elif isinstance(tree, CallTree):
 			tree.head = evals_(tree.head, objects)
 			tree.args = [evals_(arg, objects) for arg in tree.args]
+		elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+			for i in range(tree.start, tree.end):
+				tree.items[i] = evals_(tree.items[i], objects)
 		return tree
 	except StopEvaluation as e:
 		raise(e)
@@ -838,55 +1062,1097 @@ def evals_(tree, objects=[]):
 		sys.stderr.write(str(e) + "\n")
 		printStack()
 	finally:
+		if TRACERS:
+			trace("leave", stack[-1])
 		del stack[-1]
 
+# Tabling: in the restricted mode, the normal forms of calls of the functions
+# in TABLES are stored when the arguments of the call are values in normal
+# form. A tabled call is evaluated to its normal form at once, so it must not
+# be an infinite structure. Each function has a table of limited size, from
+# which the least recently used results are dropped. The tables are emptied
+# when definitions are added.
+class Table:
+	def __init__(self, size):
+		self.size = size
+		self.results = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		# The rule that can see the calls of the function, if any
+		self.refused = None
+	def get(self, key):
+		if key in self.results:
+			self.hits += 1
+			self.results.move_to_end(key)
+			return self.results[key]
+		self.misses += 1
+		return None
+	def put(self, key, result):
+		self.results[key] = result
+		if len(self.results) > self.size:
+			self.results.popitem(last=False)
+			self.evictions += 1
+
+TABLES = {}
+TABLE_SIZE = 1000
+
+# The calls being evaluated by evalsTabled, which must not look themselves up
+tabling = set()
+
+def tableFunction(name, size=None):
+	TABLES["$" + name] = Table(TABLE_SIZE if size is None else size)
+
+def clearTables():
+	for table in TABLES.values():
+		table.results.clear()
+
+def isTabled(tree):
+	return (isinstance(tree, CallTree) and isinstance(tree.head, VarTree) and tree.head.name in TABLES
+		and tree.getHead() in FUNCTIONS and TABLES[tree.head.name].refused is None)
+
+# A tabled call is evaluated to its normal form at once, so the call around it
+# sees only the value and not the forms before it, and a rule that matches one
+# of them would no longer match. A function is therefore not tabled if its
+# calls, or the functions and variables that may hold their values, are in an
+# argument that a pattern, an optimization or a builtin looks into. Calls in
+# queries are not checked.
+def checkTables():
+	for name, table in TABLES.items():
+		refused = inspectingRule(name)
+		if refused is not None and table.refused is None:
+			sys.stderr.write("Warning: " + name[1:] + " is not tabled, since " + refused + " can see its calls\n")
+		table.refused = refused
+
+def inspectingRule(name):
+	carriers = set([head for head in FUNCTIONS if isinstance(head, tuple) and head[0].name == name])
+	variables = set()
+	while True:
+		size = len(carriers) + len(variables)
+		for defi in DEFS:
+			for tree, var in [(defi.right, None)] + [(body, var) for var, body in defi.where]:
+				refused = findCarriers(tree, defi, var, None, carriers, variables)
+				if refused is not None:
+					return refused
+		if len(carriers) + len(variables) == size:
+			return None
+
+# Finds the calls and variables that may hold the value of a tabled call in a
+# body of defi, or in the missä body of var. The context is the head of the
+# function call around the tree and the index of the argument, or None at the
+# root of the body, where the value becomes the value of the rule.
+def findCarriers(tree, defi, var, context, carriers, variables):
+	if isinstance(tree, CallTree) and tree.getHead() in carriers or isinstance(tree, VarTree) and (tree in carriers or (defi, tree.name) in variables):
+		if context is not None:
+			return argumentRule(context, variables)
+		elif var is None:
+			carriers.add(defi.left.getHead() if isinstance(defi.left, CallTree) else defi.left)
+		else:
+			variables.add((defi, var))
+		return None
+	if isinstance(tree, CallTree) and tree.getHead() in FUNCTIONS:
+		children = [(arg, (tree.getHead(), i)) for i, arg in enumerate(tree.args)]
+	elif isinstance(tree, CallTree):
+		children = [(arg, context) for arg in tree.args]
+	elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		children = [(e, context) for e in tree.elements()]
+	else:
+		children = []
+	for child, childContext in children:
+		refused = findCarriers(child, defi, var, childContext, carriers, variables)
+		if refused is not None:
+			return refused
+	return None
+
+# The rule that looks into the argument, or None if the rules only bind it to
+# variables, which then hold the value. List fusion looks at the same
+# arguments as the rules of the list operations.
+def argumentRule(context, variables):
+	head, i = context
+	if magic:
+		for item in OPTIMIZATIONS + BUILTINS:
+			if item.operator is not None and head[0].name == item.operator and head[1:] == (item.opcase, item.argcases):
+				return "the " + ("builtin " if item in BUILTINS else "optimization ") + item.operator[1:]
+		if vectorize and VECTOR_FOLD.fold(head[0]) is not None:
+			return "the builtin fold of " + head[0].name[1:]
+	for defi in DEFS:
+		if isinstance(defi.left, CallTree) and defi.left.getHead() == head:
+			pattern = defi.left.args[i]
+			counts = {}
+			countVariables(defi.left, set([pattern.name]) if isPatternVar(pattern) else set(), counts)
+			if not isPatternVar(pattern) or counts[pattern.name] > 1:
+				return "the rule " + (defi.source or defi.left.inflect("nimento"))
+			variables.add((defi, pattern.name))
+	return None
+
+# In the restricted mode, rules cannot rewrite a tree that does not call
+# functions. Worlds are not values, so IO is never tabled.
+def isValue(tree):
+	if isinstance(tree, CallTree):
+		return tree.getHead() not in FUNCTIONS and isValue(tree.head) and all([isValue(arg) for arg in tree.args])
+	elif isinstance(tree, NumListTree):
+		return True
+	elif isinstance(tree, ListTree):
+		return all([isValue(e) for e in tree.elements()])
+	return not isinstance(tree, WorldTree) and tree not in FUNCTIONS
+
+# A value is in normal form if no optimization or builtin applies to it
+def isNormal(tree):
+	if isinstance(tree, CallTree):
+		if magic and any([opt.match(tree) for opt in OPTIMIZATIONS + BUILTINS]):
+			return False
+		return isNormal(tree.head) and all([isNormal(arg) for arg in tree.args])
+	elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		return all([isNormal(e) for e in tree.elements()])
+	return True
+
+# A hashable key that is equal for structurally equal trees
+def termKey(tree):
+	if isinstance(tree, CallTree):
+		return (termKey(tree.head), tree.headInfl, tree.argInfls, tuple([termKey(arg) for arg in tree.args]))
+	elif isinstance(tree, ListTree):
+		return ("lista",) + tuple([termKey(e) for e in tree.elements()])
+	elif isinstance(tree, NumTree):
+		return tree.num
+	return tree.name
+
+def evalsTabled(tree):
+	global changed
+	table = TABLES[tree.head.name]
+	key = termKey(tree)
+	result = table.get(key)
+	if result is not None:
+		return result
+	outer = changed
+	tabling.add(id(tree))
+	try:
+		result = tree
+		while True:
+			changed = False
+			result = evals_(result)
+			if not changed:
+				break
+	finally:
+		tabling.discard(id(tree))
+		changed = outer
+	table.put(key, result)
+	return result
+
+# Constants: in the restricted mode, a definition without arguments always
+# has the same value. The first copy of the body of each constant is followed
+# through its evaluation, and once it has reached a value in normal form,
+# the constant is rewritten to that value instead of a new copy of the body,
+# also in later queries of the REPL. A definition added later can change the
+# value even if the value does not mention the defined word: a new rule can
+# change which arguments are evaluated before the rules are matched, and with
+# it the rule that matches. All remembered values are therefore forgotten
+# when a definition is added.
+#
+# The call around a constant sees every form of the body on the way to the
+# value, and a rule that matches one of the forms, or the value at an earlier
+# step than it would otherwise be reached, can change the result. Nothing is
+# around the tree that evals starts from, so a constant there, such as a query
+# of the REPL or the tulos of another query, always gets its remembered value.
+# Elsewhere the value is used only if no argument of a pattern, no
+# optimization and no builtin could match the value or any of the forms. A
+# body that is already a value in normal form is used everywhere, since no
+# steps are skipped.
+CONSTANTS = {}
+
+# The followed copies of the constants being evaluated, by id, with the
+# constant and whether all their forms so far have been hidden, and the
+# constants that have a followed copy
+pendingConstants = {}
+trackedConstants = set()
+
+def trackConstant(defi, tree):
+	trackedConstants.add(defi)
+	if isValue(tree) and isNormal(tree):
+		CONSTANTS[defi] = (tree, True)
+	else:
+		pendingConstants[id(tree)] = (defi, tree, not isObservable(tree))
+
+# A step of evals_ that changes nothing below the tree leaves it in normal form.
+# A value that is not such is checked, since it is no longer followed.
+def evalsConstant(tree, objects):
+	global changed
+	defi, _, hidden = pendingConstants.pop(id(tree))
+	outer = changed
+	changed = False
+	result = evals_(tree, objects, False)
+	hidden = hidden and not isObservable(result)
+	if isValue(result) and (not changed or isNormal(result)):
+		CONSTANTS[defi] = (result, hidden)
+	else:
+		pendingConstants[id(result)] = (defi, result, hidden)
+	changed = changed or outer
+	return result
+
+# A followed copy may have become a value without being evaluated again
+def finishConstants():
+	for defi, tree, hidden in pendingConstants.values():
+		if isValue(tree) and isNormal(tree):
+			CONSTANTS[defi] = (tree, hidden and not isObservable(tree))
+	pendingConstants.clear()
+	trackedConstants.clear()
+
+# The subpatterns of the arguments of the rules, None when outdated
+ARGUMENT_PATTERNS = None
+
+def argumentPatterns():
+	global ARGUMENT_PATTERNS
+	if ARGUMENT_PATTERNS is None:
+		ARGUMENT_PATTERNS = []
+		for defi in DEFS:
+			if isinstance(defi.left, CallTree):
+				for arg in defi.left.args:
+					collectSubpatterns(arg, ARGUMENT_PATTERNS)
+	return ARGUMENT_PATTERNS
+
+def collectSubpatterns(pattern, patterns):
+	if isPatternVar(pattern):
+		return
+	patterns += [pattern]
+	if isinstance(pattern, CallTree):
+		for arg in pattern.args:
+			collectSubpatterns(arg, patterns)
+
+# Tells whether the call around a constant could match a form of the constant.
+# The optimizations and builtins look at numbers and lists, also inside
+# constructors, and list fusion looks at the list operations.
+def isObservable(tree):
+	if magic and (hasNumbersOrLists(tree) or listOperation(tree) is not None):
+		return True
+	return any([pattern.match(tree)[0] for pattern in argumentPatterns()])
+
+def hasNumbersOrLists(tree):
+	if isinstance(tree, NumTree) or asList(tree) is not None:
+		return True
+	return isinstance(tree, CallTree) and not isFunctionCall(tree) and any([hasNumbersOrLists(arg) for arg in tree.args])
+
+# Pragma comments: "# taulukoi: väri, nimi 100" tables the given
+# functions, optionally with a table size
+PRAGMA_REGEX = re.compile(r"\s*#\s*taulukoi:(.*)")
+
+def readPragma(line):
+	match = PRAGMA_REGEX.match(line)
+	if not match:
+		return
+	for item in match.group(1).split(","):
+		words = item.split()
+		if len(words) == 1 or (len(words) == 2 and words[1].isdigit()):
+			tableFunction(words[0], int(words[1]) if len(words) == 2 else None)
+		elif words:
+			sys.stderr.write("Warning: invalid pragma: " + item.strip() + "\n")
+
+# Tracing: the evaluator reports events to the tracers in TRACERS. Tracer
+# defines every event as a no-op, so a tracer overrides only the events it
+# needs. When TRACERS is empty, no events are created.
+class Tracer:
+	# evals_ starts or stops evaluating a tree
+	def enter(self, tree):
+		pass
+	def leave(self, tree):
+		pass
+	# A rule did not match the tree; only sent if some tracer overrides it
+	def attempt(self, tree, defi):
+		pass
+	# The scan of DEFS stopped at the given index, len(DEFS) if nothing matched
+	def scanned(self, tree, index):
+		pass
+	def rewrite(self, tree, defi, result):
+		pass
+	def optimization(self, tree, opt):
+		pass
+	def builtin(self, tree, bi):
+		pass
+	# An IO operation created the next world
+	def world(self, world):
+		pass
+	# evals completed a step that changed the expression, or finished
+	def step(self, tree):
+		pass
+	def end(self, tree):
+		pass
+	# The evaluation was stopped by an error
+	def stop(self):
+		pass
+
+TRACERS = []
+tracingAttempts = False
+
+def addTracer(tracer):
+	global tracingAttempts
+	TRACERS.append(tracer)
+	tracingAttempts = any([type(t).attempt is not Tracer.attempt for t in TRACERS])
+
+def trace(event, *args):
+	for tracer in TRACERS:
+		getattr(tracer, event)(*args)
+
+# --debug: prints the matches, and with -VV also the failed attempts
+class DebugTracer(Tracer):
+	def __init__(self, verbosity):
+		self.verbosity = verbosity
+	def attempt(self, tree, defi):
+		if self.verbosity >= 2:
+			print(" "*len(stack) + "\x1b[1;4;31mNO MATCH:\x1b[0m " + tree.str() + " \x1b[1;4;34m!=\x1b[0m " + defi.left.str() + " \x1b[1;33m(def)\x1b[0m")
+	def rewrite(self, tree, defi, result):
+		if self.verbosity >= 1:
+			print(" "*len(stack) + "\x1b[1;4;31mMatch:\x1b[0m " + tree.str() + " \x1b[1;4;34m==\x1b[0m " + defi.left.str() + " \x1b[1;4;34m->\x1b[0m " + result.str())
+	def optimization(self, tree, opt):
+		if self.verbosity >= 1:
+			print(" "*len(stack) + "\x1b[1;4;31mMatch:\x1b[0m " + tree.str() + " \x1b[1;33m(opt)\x1b[0m")
+	def builtin(self, tree, bi):
+		if self.verbosity >= 1:
+			print(" "*len(stack) + "\x1b[1;4;31mMatch:\x1b[0m " + tree.str() + " \x1b[1;33m(builtin)\x1b[0m")
+	def end(self, tree):
+		if self.verbosity >= 1:
+			print("\x1b[1;4;31mEnd:\x1b[0m " + tree.str())
+
+# --visualize: prints the whole expression after every step
+class VisualizeTracer(Tracer):
+	def step(self, tree):
+		print(tree.inflect("nimento"))
+
+# --trace N: keeps the last N events and prints them when the evaluation
+# is stopped by an error
+class RingTracer(Tracer):
+	def __init__(self, size):
+		self.events = collections.deque(maxlen=size)
+	def rewrite(self, tree, defi, result):
+		self.events.append(("rewrite", tree, (defi.source or "-") + " " + defi.left.str()))
+	def optimization(self, tree, opt):
+		self.events.append(("optimization", tree, opt.operator))
+	def builtin(self, tree, bi):
+		self.events.append(("builtin", tree, bi.operator or type(bi).__name__))
+	def world(self, world):
+		self.events.append(("world", world, ""))
+	def stop(self):
+		if self.events:
+			sys.stderr.write("Last events:\n")
+			for event, tree, what in self.events:
+				text = tree.str()
+				sys.stderr.write("  %-12s %s  %s\n" % (event, text if len(text) <= 200 else text[:200] + "...", what))
+			self.events.clear()
+
+# --profile: counts the match attempts and rewrites of each rule and the
+# hits of optimizations and builtins. The time from the start of a matching
+# round to a rewrite is attributed to the rule, and the time of the evals_
+# frames of each function, including the evaluation of its arguments, is
+# summed up through the stack. Recursive frames are counted only once.
+class Profiler(Tracer):
+	def __init__(self):
+		self.stops = {}
+		self.rewrites = {}
+		self.times = {}
+		self.calls = {}
+		self.cumulative = {}
+		self.active = {}
+		self.frames = []
+	def enter(self, tree):
+		name = functionName(tree)
+		now = time.perf_counter()
+		if name is not None:
+			self.calls[name] = self.calls.get(name, 0) + 1
+			self.active[name] = self.active.get(name, 0) + 1
+		self.frames += [[name, now, now]]
+	def leave(self, tree):
+		name, start, round = self.frames.pop()
+		if name is not None:
+			self.active[name] -= 1
+			if self.active[name] == 0:
+				self.cumulative[name] = self.cumulative.get(name, 0) + time.perf_counter() - start
+	def scanned(self, tree, index):
+		self.stops[index] = self.stops.get(index, 0) + 1
+	def rewrite(self, tree, item, result=None):
+		now = time.perf_counter()
+		frame = self.frames[-1]
+		self.rewrites[item] = self.rewrites.get(item, 0) + 1
+		self.times[item] = self.times.get(item, 0) + now - frame[2]
+		frame[2] = now
+	def optimization(self, tree, opt):
+		self.rewrite(tree, opt)
+	def builtin(self, tree, bi):
+		self.rewrite(tree, bi)
+	def rows(self):
+		rows = []
+		attempts = 0
+		for index in range(len(DEFS), -1, -1):
+			attempts += self.stops.get(index, 0)
+			if index < len(DEFS) and attempts > 0:
+				defi = DEFS[index]
+				rows += [{"source": defi.source, "rule": defi.left.inflect("nimento"), "attempts": attempts,
+					"rewrites": self.rewrites.get(defi, 0), "time": self.times.get(defi, 0)}]
+		for item in OPTIMIZATIONS + BUILTINS:
+			if item in self.rewrites:
+				kind = "(builtin)" if item in BUILTINS else "(optimization)"
+				name = item.operator[1:] if item.operator else type(item).__name__
+				rows += [{"source": kind, "rule": name, "attempts": self.rewrites[item],
+					"rewrites": self.rewrites[item], "time": self.times[item]}]
+		return sorted(rows, key=lambda row: (-row["time"], -row["attempts"]))
+	def functions(self):
+		rows = [{"function": name[1:], "calls": self.calls[name], "cumulative": self.cumulative.get(name, 0)} for name in self.calls]
+		return sorted(rows, key=lambda row: -row["cumulative"])
+	def tables(self):
+		rows = []
+		for name, table in sorted(TABLES.items()):
+			lookups = table.hits + table.misses
+			rows += [{"function": name[1:], "hits": table.hits, "misses": table.misses, "hit_rate": table.hits / lookups if lookups else None,
+				"evictions": table.evictions, "entries": len(table.results), "size": table.size}]
+		return rows
+	def report(self, jsonFile=None):
+		rows = self.rows()
+		functions = self.functions()
+		tables = self.tables()
+		sys.stderr.write("%-20s %10s %10s %10s  %s\n" % ("source", "attempts", "rewrites", "time (s)", "rule"))
+		for row in rows:
+			sys.stderr.write("%-20s %10d %10d %10.4f  %s\n" % (row["source"] or "-", row["attempts"], row["rewrites"], row["time"], row["rule"]))
+		sys.stderr.write("\n%10s %14s  %s\n" % ("calls", "cumulative (s)", "function"))
+		for row in functions:
+			sys.stderr.write("%10d %14.4f  %s\n" % (row["calls"], row["cumulative"], row["function"]))
+		if tables:
+			sys.stderr.write("\n%10s %10s %8s %10s %10s  %s\n" % ("hits", "misses", "hit rate", "evictions", "entries", "tabled function"))
+			for row in tables:
+				rate = "-" if row["hit_rate"] is None else "%.1f%%" % (100 * row["hit_rate"])
+				sys.stderr.write("%10d %10d %8s %10d %10s  %s\n" % (row["hits"], row["misses"], rate, row["evictions"], "%d/%d" % (row["entries"], row["size"]), row["function"]))
+		if jsonFile:
+			with open(jsonFile, "w") as file:
+				json.dump({"rules": rows, "functions": functions, "tables": tables}, file, indent=1, ensure_ascii=False)
+
+# The name of the function that is called in the tree, or None
+def functionName(tree):
+	if isinstance(tree, CallTree) and isinstance(tree.head, VarTree):
+		return tree.head.name
+	elif isinstance(tree, VarTree):
+		return tree.name
+	return None
+
+# Sampling profiler: a SIGPROF timer snapshots the stack of trees every
+# interval of CPU time, and the function names of the stack are written in
+# the collapsed format of flame graph tools ("a;b;c count"). Unlike
+# --profile, evals_ does not know about the sampler, so it can be switched
+# on and off with SIGUSR1 while the program runs.
+class Sampler:
+	def __init__(self, filename, interval):
+		self.filename = filename
+		self.interval = interval
+		self.counts = {}
+		self.running = False
+	def sample(self, signum, frame):
+		names = [functionName(tree) for tree in list(stack)]
+		key = ";".join([name[1:] for name in names if name is not None])
+		if key:
+			self.counts[key] = self.counts.get(key, 0) + 1
+	def start(self):
+		self.counts = {}
+		self.running = True
+		signal.signal(signal.SIGPROF, self.sample)
+		signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+	def stop(self):
+		signal.setitimer(signal.ITIMER_PROF, 0)
+		self.running = False
+		with open(self.filename, "w") as file:
+			for key, count in sorted(self.counts.items()):
+				file.write(key + " " + str(count) + "\n")
+		sys.stderr.write("Wrote " + str(sum(self.counts.values())) + " samples to " + self.filename + "\n")
+	def toggle(self, signum=None, frame=None):
+		if self.running:
+			self.stop()
+		else:
+			self.start()
+	def finish(self):
+		if self.running:
+			self.stop()
+
+# Memory accounting: the live terms are the trees on the evaluation stack and
+# everything reachable from them. Shared nodes are counted once, and the sizes
+# in bytes are approximations made with sys.getsizeof.
+def termChildren(tree):
+	if isinstance(tree, CallTree):
+		return [tree.head] + tree.args
+	elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		return tree.elements()
+	return []
+
+def nodeBytes(tree):
+	size = sys.getsizeof(tree) + sys.getsizeof(tree.__dict__)
+	if isinstance(tree, CallTree):
+		size += sys.getsizeof(tree.args)
+	elif isinstance(tree, ListTree):
+		size += sys.getsizeof(tree.items)
+	return size
+
+def countTerms(roots):
+	counts = {}
+	size = 0
+	visited = set()
+	todo = list(roots)
+	while todo:
+		tree = todo.pop()
+		if id(tree) in visited:
+			continue
+		visited.add(id(tree))
+		name = type(tree).__name__
+		counts[name] = counts.get(name, 0) + 1
+		size += nodeBytes(tree)
+		todo += termChildren(tree)
+	return counts, size
+
+# The subterms with the most nodes, as (size, tree) pairs. A shared subterm
+# is counted in the size of every term that contains it.
+def biggestSubterms(roots, count):
+	sizes = {}
+	visited = set()
+	todo = [(tree, False) for tree in roots]
+	while todo:
+		tree, done = todo.pop()
+		if done:
+			sizes[id(tree)] = (1 + sum([sizes[id(child)][0] for child in termChildren(tree) if id(child) in sizes]), tree)
+		elif id(tree) not in visited:
+			visited.add(id(tree))
+			todo += [(tree, True)] + [(child, False) for child in termChildren(tree)]
+	return sorted(sizes.values(), key=lambda item: -item[0])[:count]
+
+# SIGUSR2, or --memory when the evaluation stops on an error
+def printSnapshot(count=10):
+	sys.stderr.write("Biggest subterms:\n")
+	for size, tree in biggestSubterms(list(stack), count):
+		text = tree.str()
+		sys.stderr.write("  %8d  %s\n" % (size, text if len(text) <= 200 else text[:200] + "..."))
+
+# The number of nodes subs creates when it substitutes into the tree
+def copiedNodes(tree):
+	if isinstance(tree, CallTree) and tree.variables == frozenset():
+		return 0
+	if isinstance(tree, CallTree):
+		return 1 + copiedNodes(tree.head) + sum([copiedNodes(arg) for arg in tree.args])
+	elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		return 1 + sum([copiedNodes(e) for e in tree.elements()])
+	return 0
+
+# --memory: counts the live nodes by type every N evaluation steps and
+# keeps the largest count, and sums up the nodes allocated by the
+# substitutions of each rule
+class MemoryTracer(Tracer):
+	def __init__(self, interval=1):
+		self.interval = interval
+		self.steps = 0
+		self.peak = {"nodes": 0, "bytes": 0, "step": 0, "counts": {}}
+		self.rewrites = {}
+		self.allocated = {}
+		self.sizes = {}
+	def step(self, tree):
+		self.steps += 1
+		if self.steps % self.interval == 0:
+			self.sample(tree)
+	def end(self, tree):
+		self.sample(tree)
+	def sample(self, tree):
+		counts, size = countTerms(list(stack) + [tree])
+		nodes = sum(counts.values())
+		if nodes > self.peak["nodes"]:
+			self.peak = {"nodes": nodes, "bytes": size, "step": self.steps, "counts": counts}
+	def rewrite(self, tree, defi, result):
+		self.rewrites[defi] = self.rewrites.get(defi, 0) + 1
+		# Without variables the body itself is the result
+		if result is defi.right:
+			return
+		if defi not in self.sizes:
+			self.sizes[defi] = copiedNodes(defi.right) + sum([copiedNodes(body) for var, body in defi.where])
+		self.allocated[defi] = self.allocated.get(defi, 0) + self.sizes[defi]
+	def stop(self):
+		printSnapshot()
+	def rows(self):
+		rows = [{"source": defi.source, "rule": defi.left.inflect("nimento"), "rewrites": self.rewrites[defi],
+			"allocated": self.allocated.get(defi, 0)} for defi in self.rewrites]
+		return sorted(rows, key=lambda row: -row["allocated"])
+	def report(self, jsonFile=None):
+		rows = self.rows()
+		peak = self.peak
+		sys.stderr.write("Peak: %d nodes, about %d kB, at step %d of %d (%s)\n" % (peak["nodes"], peak["bytes"] // 1024, peak["step"], self.steps,
+			", ".join(["%s %d" % item for item in sorted(peak["counts"].items())])))
+		sys.stderr.write("%-20s %10s %10s  %s\n" % ("source", "rewrites", "allocated", "rule"))
+		for row in rows:
+			sys.stderr.write("%-20s %10d %10d  %s\n" % (row["source"] or "-", row["rewrites"], row["allocated"], row["rule"]))
+		if jsonFile:
+			with open(jsonFile, "w") as file:
+				json.dump({"steps": self.steps, "peak": peak, "rules": rows}, file, indent=1, ensure_ascii=False)
+
 DEFS = []
 FUNCTIONS = set()
 
-def evalFile(filename):
+# Reads the logical lines of a file, joining lines that end with a backslash.
+# Yields the number of the first physical line of each logical line and the line.
+def readLines(filename):
 	with open(filename) as lines:
+		number = 0
 		try:
 			while True:
 				line = next(lines)
+				number += 1
 				if line == "\n":
 					continue
+				first = number
 				while line[-2] == "\\":
 					line = line[:-2]
 					line += next(lines)
-				try:
-					evalLine(line)
-				except StopEvaluation:
-					pass
+					number += 1
+				yield first, line
 		except StopIteration:
 			pass
 
-def evalLine(line, allowQueries=False):
-	global DEFS
+# The location of a definition, used in profiles
+def sourceLocation(filename, number):
+	return os.path.basename(filename) + ":" + str(number)
+
+def evalFile(filename):
+	if jobs > 1:
+		evalFileParallel(filename)
+		return
+	for number, line in readLines(filename):
+		try:
+			evalLine(line, source=sourceLocation(filename, number))
+		except StopEvaluation:
+			pass
+
+def parseLine(line, allowQueries=False):
 	output = lexLine(line)
 	if not output:
-		return
+		return []
 	if debug and verbosity >= 0:
 		print(" ".join(["|".join(set([a.str() for a in alternatives])) for alternatives in output]))
+	words = TokenStream(output)
 	if not allowQueries:
-		eqs = parseWhen(output)
+		return parseWhen(words)
 	else:
-		eqs = [parseEq(output, True)]
-	for eq in eqs:
+		return [parseEq(words, True)]
+
+def evalLine(line, allowQueries=False, source=None):
+	readPragma(line)
+	for eq in parseLine(line, allowQueries):
 		if debug and verbosity >= 0:
 			print(eq.str())
 		if eq.query():
-			return evals(eq.left)
+			return evalsCached(eq.left)
 		elif eq.op == "#olla":
-			DEFS += [eq]
-			if not freeMode:
-				if isinstance(eq.left, CallTree):
-					FUNCTIONS.add(eq.left.getHead())
-				else:
-					FUNCTIONS.add(eq.left)
+			addDefinition(eq, source)
+
+def addDefinition(eq, source=None):
+	global DEFS, STRICT, ARGUMENT_PATTERNS
+	if magic:
+		eq = EqTree(eq.op, eq.always, eq.left, listLiterals(eq.right),
+			[(var, listLiterals(body)) for var, body in eq.where])
+	eq.source = source
+	names = patternVariables(eq.left) | set([var for var, body in eq.where])
+	# A body without substitutions is shared as it is and evaluated in place
+	if names or (eq.always and (impure or not freeMode)):
+		counts = {}
+		for tree in [eq.right] + [body for var, body in eq.where]:
+			analyzeVariables(tree, names)
+			countVariables(tree, names, counts)
+		eq.thawed = frozenset([name for name in counts if counts[name] > 1])
+	# Calls of aliases like "x summattuna y:hyn on x plus y" are not replaced
+	# by the bodies of the aliases: an argument that skips a step is one step
+	# ahead of the other arguments when the call around it is matched, which
+	# can change the rule that matches. The optimizations and builtins of the
+	# magic mode skip steps in the same way, but only for the operators of the
+	# standard library on evaluated numbers and lists, like the optimizations
+	# of the original interpreter, and --no-magic turns them off. Inlining
+	# would change the timing of any rule of the program, in both modes.
+	DEFS += [eq]
+	STRICT = None
+	ARGUMENT_PATTERNS = None
+	VECTOR_FOLD.cache.clear()
+	if TABLES:
+		clearTables()
+	CONSTANTS.clear()
+	if not freeMode:
+		if isinstance(eq.left, CallTree):
+			FUNCTIONS.add(eq.left.getHead())
+		else:
+			FUNCTIONS.add(eq.left)
+
+# A copy of a shared call of a rule body that can be evaluated in place. The
+# arguments are still shared.
+def thaw(tree):
+	if isinstance(tree, CallTree) and tree.variables is not None:
+		copy = CallTree(None, None, tree.headInfl, tree.argInfls)
+		copy.head = tree.head
+		copy.args = tree.args
+		return copy
+	return tree
+
+def patternVariables(tree):
+	if isinstance(tree, CallTree):
+		return patternVariables(tree.head).union(*[patternVariables(arg) for arg in tree.args])
+	elif isPatternVar(tree):
+		return set([tree.name])
+	return set()
+
+# Rule bodies are analyzed when they are defined: each CallTree of a body
+# records the variables of the rule that it contains. subs shares the calls
+# that contain none of the substituted variables, and evals_ copies such
+# calls instead of evaluating them in place. The items of a list are changed
+# in place for all slices of the list, so lists and the calls that contain
+# them are not shared but copied as before.
+def analyzeVariables(tree, names):
+	if isinstance(tree, CallTree):
+		children = [analyzeVariables(child, names) for child in [tree.head] + tree.args]
+		tree.variables = None if None in children else frozenset().union(*children)
+		return tree.variables
+	elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		for e in tree.elements():
+			analyzeVariables(e, names)
+		return None
+	elif isinstance(tree, VarTree) and tree.name in names:
+		return frozenset([tree.name])
+	return frozenset()
+
+def countVariables(tree, names, counts):
+	if isinstance(tree, CallTree):
+		countVariables(tree.head, names, counts)
+		for arg in tree.args:
+			countVariables(arg, names, counts)
+	elif isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		for e in tree.elements():
+			countVariables(e, names, counts)
+	elif isinstance(tree, VarTree) and tree.name in names:
+		counts[tree.name] = counts.get(tree.name, 0) + 1
+
+# Tiered compilation: a rule is matched and substituted by walking its trees,
+# which costs nothing up front for rules that never fire. When a rule has
+# fired JIT_THRESHOLD times, Python source that matches its pattern and builds
+# its body is generated and compiled, and the rule uses it from then on. The
+# generated matcher gives the same substitutions as CallTree.match, and the
+# generated builder shares the same subtrees as subs.
+jit = True
+JIT_THRESHOLD = 100
+dumpJit = False
+
+NUMBER_PATTERNS = [
+	("$seuraaja", "", ("omanto",), "> 0", "%s - 1"),
+	("$negatiivinen", "olento", ("",), "< 0", "-%s"),
+]
+
+class CompiledRule:
+	def __init__(self, match, build, source):
+		self.match = match
+		self.build = build
+		self.source = source
+
+# Raised for trees that the generated code does not handle
+class NotCompilable(Exception):
+	pass
+
+class RuleCompiler:
+	def __init__(self):
+		self.lines = []
+		self.constants = {}
+		self.locals = 0
+		self.bound = set()
+	def emit(self, indent, line):
+		self.lines += ["\t" * indent + line]
+	def constant(self, value):
+		name = "c%d" % len(self.constants)
+		self.constants[name] = value
+		return name
+	def local(self):
+		self.locals += 1
+		return "t%d" % self.locals
+	def fail(self, indent):
+		self.emit(indent, "return False, {}")
+	# Emits code that matches the pattern against the tree in the local t
+	def match(self, pattern, t, indent):
+		if isPatternVar(pattern):
+			if pattern.name in self.bound:
+				self.emit(indent, "if not s[%r].safeEq(%s):" % (pattern.name, t))
+				self.fail(indent + 1)
+			else:
+				self.emit(indent, "s[%r] = %s" % (pattern.name, t))
+				self.bound.add(pattern.name)
+		elif isinstance(pattern, VarTree) and pattern.name != "$nolla" and not pattern.name.lstrip("-").isdigit():
+			# No number has this name
+			self.emit(indent, "if not isinstance(%s, VarTree) or %s.name != %r:" % (t, t, pattern.name))
+			self.fail(indent + 1)
+		elif isinstance(pattern, VarTree):
+			self.emit(indent, "if isinstance(%s, VarTree):" % t)
+			self.emit(indent + 1, "if %s.name != %r:" % (t, pattern.name))
+			self.fail(indent + 2)
+			self.emit(indent, "elif isinstance(%s, NumTree):" % t)
+			if pattern.name == "$nolla":
+				self.emit(indent + 1, "if %s.num != 0:" % t)
+			else:
+				self.emit(indent + 1, "if str(%s.num) != %r:" % (t, pattern.name))
+			self.fail(indent + 2)
+			self.emit(indent, "else:")
+			self.fail(indent + 1)
+		elif isinstance(pattern, NumTree):
+			names = ["$nolla", "0"] if pattern.num == 0 else [str(pattern.num)]
+			self.emit(indent, "if isinstance(%s, NumTree):" % t)
+			self.emit(indent + 1, "if %s.num != %d:" % (t, pattern.num))
+			self.fail(indent + 2)
+			self.emit(indent, "elif isinstance(%s, VarTree):" % t)
+			self.emit(indent + 1, "if %s.name not in %r:" % (t, names))
+			self.fail(indent + 2)
+			self.emit(indent, "else:")
+			self.fail(indent + 1)
+		elif isinstance(pattern, CallTree):
+			self.matchCall(pattern, t, indent)
+		else:
+			raise NotCompilable()
+	def matchCall(self, pattern, t, indent):
+		if pattern.headIs("$lisätty", "olento", ("", "sisatulento")):
+			self.emit(indent, "if isinstance(%s, ListTree):" % t)
+			self.emit(indent + 1, "%s = %s.uncons()" % (t, t))
+		# Each branch binds the same variables
+		bound = self.bound
+		self.bound = set(bound)
+		self.emit(indent, "if isinstance(%s, CallTree):" % t)
+		self.emit(indent + 1, "if %s.headInfl != %r or len(%s.args) != %d:" % (t, pattern.headInfl, t, len(pattern.args)))
+		self.fail(indent + 2)
+		head = self.local()
+		self.emit(indent + 1, "%s = %s.head" % (head, t))
+		self.match(pattern.head, head, indent + 1)
+		if pattern.args:
+			self.emit(indent + 1, "if %s:" % " or ".join(["%s.argInfls[%d] != %r" % (t, i, infl) for i, infl in enumerate(pattern.argInfls)]))
+			self.fail(indent + 2)
+		for i, arg in enumerate(pattern.args):
+			local = self.local()
+			self.emit(indent + 1, "%s = %s.args[%d]" % (local, t, i))
+			self.match(arg, local, indent + 1)
+		matched = self.bound
+		# Numbers match the patterns of seuraaja and negatiivinen
+		for head, headInfl, argInfls, condition, number in NUMBER_PATTERNS:
+			if pattern.headIs(head, headInfl, argInfls):
+				self.bound = set(bound)
+				local = self.local()
+				self.emit(indent, "elif isinstance(%s, NumTree) and %s.num %s:" % (t, t, condition))
+				self.emit(indent + 1, "%s = %s" % (local, number % (t + ".num")))
+				self.matchNumber(pattern.args[0], local, indent + 1)
+		self.emit(indent, "else:")
+		self.fail(indent + 1)
+		self.bound = matched
+	# Emits code that matches the pattern against the number in the local n
+	def matchNumber(self, pattern, n, indent):
+		if isPatternVar(pattern):
+			if pattern.name in self.bound:
+				self.emit(indent, "if not s[%r].safeEq(NumTree(%s)):" % (pattern.name, n))
+				self.fail(indent + 1)
+			else:
+				self.emit(indent, "s[%r] = NumTree(%s)" % (pattern.name, n))
+				self.bound.add(pattern.name)
+			return
+		elif isinstance(pattern, VarTree) and pattern.name == "$nolla":
+			self.emit(indent, "if %s != 0:" % n)
+		elif isinstance(pattern, VarTree) and pattern.name.lstrip("-").isdigit():
+			self.emit(indent, "if str(%s) != %r:" % (n, pattern.name))
+		elif isinstance(pattern, NumTree):
+			self.emit(indent, "if %s != %d:" % (n, pattern.num))
+		elif isinstance(pattern, CallTree):
+			for head, headInfl, argInfls, condition, number in NUMBER_PATTERNS:
+				if pattern.headIs(head, headInfl, argInfls):
+					local = self.local()
+					self.emit(indent, "if not %s %s:" % (n, condition))
+					self.fail(indent + 1)
+					self.emit(indent, "%s = %s" % (local, number % n))
+					self.matchNumber(pattern.args[0], local, indent)
+					return
+			self.fail(indent)
+			return
+		else:
+			self.fail(indent)
+			return
+		self.fail(indent + 1)
+	# Returns an expression that builds the body, or raises NotCompilable
+	def build(self, tree, names):
+		if isinstance(tree, CallTree):
+			if tree.variables is not None and tree.variables.isdisjoint(names):
+				return self.constant(tree)
+			args = ", ".join([self.build(arg, names) for arg in tree.args])
+			return "buildCall(%s, [%s], %r, %s)" % (self.build(tree.head, names), args, tree.headInfl, self.constant(tree.argInfls))
+		elif isinstance(tree, NumListTree):
+			return self.constant(tree)
+		elif isinstance(tree, ListTree):
+			return "ListTree([%s])" % ", ".join([self.build(e, names) for e in tree.elements()])
+		elif isinstance(tree, VarTree) and tree.name in names:
+			return "s[%r]" % tree.name
+		elif isinstance(tree, AtomicTree):
+			return self.constant(tree)
+		raise NotCompilable()
+
+def buildCall(head, args, headInfl, argInfls):
+	tree = CallTree(None, None, headInfl, argInfls)
+	tree.head = head
+	tree.args = args
+	return tree
+
+# subs copies a node that occurs several times in a body only once, which
+# the generated builder does not do
+def hasSharedNodes(tree, seen):
+	if isinstance(tree, CallTree) or isinstance(tree, ListTree) and not isinstance(tree, NumListTree):
+		if any([node is tree for node in seen]):
+			return True
+		seen += [tree]
+		children = [tree.head] + tree.args if isinstance(tree, CallTree) else tree.elements()
+		return any([hasSharedNodes(child, seen) for child in children])
+	return False
+
+def compileRule(defi):
+	compiler = RuleCompiler()
+	compiler.emit(0, "def match(tree):")
+	compiler.emit(1, "s = {}")
+	try:
+		compiler.match(defi.left, "tree", 1)
+		compiler.emit(1, "return True, s")
+		matcher = compiler.lines
+	except NotCompilable:
+		matcher = []
+	compiler.lines = []
+	names = patternVariables(defi.left) | set([var for var, body in defi.where])
+	if not hasSharedNodes(defi.right, []):
+		try:
+			compiler.emit(0, "def build(s):")
+			compiler.emit(1, "return " + compiler.build(defi.right, names))
+		except NotCompilable:
+			compiler.lines = []
+	source = "\n".join(matcher + compiler.lines) + "\n"
+	namespace = dict(compiler.constants)
+	namespace.update({"CallTree": CallTree, "VarTree": VarTree, "NumTree": NumTree, "ListTree": ListTree, "buildCall": buildCall})
+	exec(compile(source, "<%s>" % (defi.source or "rule"), "exec"), namespace)
+	defi.compiled = CompiledRule(namespace.get("match", defi.left.match), namespace.get("build", defi.right.subs), source)
+	if dumpJit:
+		sys.stderr.write("# %s: %s\n%s\n" % (defi.source or "-", defi.left.inflect("nimento"), source))
+
+# Parallel loading: lexing and parsing do not depend on DEFS, so chunks of
+# lines are handed to worker processes. Each line is parsed with eqCounter
+# starting from zero, and the names created by parseWhen are renumbered when
+# the definitions are added back in source order.
+
+CHUNKS_PER_JOB = 4
+
+def initWorker(flags):
+	global magic, freeMode, debug, verbosity
+	magic, freeMode, debug, verbosity = flags
+
+def parseChunk(lines):
+	global eqCounter
+	results = []
+	for line in lines:
+		eqCounter = 0
+		try:
+			results += [(parseLine(line), eqCounter)]
+		except StopEvaluation:
+			results += [([], eqCounter)]
+	return results
+
+# Returns copies of eqs with the parseWhen names shifted by offset
+def renumberEqs(eqs, offset):
+	names = {}
+	for eq in eqs:
+		for tree in [eq.left, eq.right] + [body for var, body in eq.where]:
+			collectEqNames(tree, names)
+	subs = {name: createEqName(counter + offset) for name, counter in names.items()}
+	return [EqTree(eq.op, eq.always, eq.left.subs(subs), eq.right.subs(subs),
+		[(var, body.subs(subs)) for var, body in eq.where]) for eq in eqs]
+
+def collectEqNames(tree, names):
+	if isinstance(tree, VarTree):
+		match = re.fullmatch(r"\$<vaihe ([0-9]+)>", tree.name)
+		if match:
+			names[tree.name] = int(match.group(1))
+	elif isinstance(tree, CallTree):
+		collectEqNames(tree.head, names)
+		for arg in tree.args:
+			collectEqNames(arg, names)
+
+def evalFileParallel(filename):
+	global eqCounter
+	numbered = list(readLines(filename))
+	lines = [line for number, line in numbered]
+	size = max(1, len(lines) // (jobs * CHUNKS_PER_JOB))
+	chunks = [lines[i:i+size] for i in range(0, len(lines), size)]
+	numbers = iter([number for number, line in numbered])
+	for line in lines:
+		readPragma(line)
+	with multiprocessing.Pool(jobs, initWorker, ((magic, freeMode, debug, verbosity),)) as pool:
+		for results in pool.imap(parseChunk, chunks):
+			for eqs, counter in results:
+				source = sourceLocation(filename, next(numbers))
+				for eq in renumberEqs(eqs, eqCounter):
+					if debug and verbosity >= 0:
+						print(eq.str())
+					if eq.op == "#olla":
+						addDefinition(eq, source)
+				eqCounter += counter
+
+# Watch mode: the file is polled for changes. Only lines whose text has
+# changed are lexed and parsed again, and the definitions of the file are
+# spliced into DEFS after the standard library in source order. Lines that
+# failed to parse are parsed again on every change, so that their errors are
+# reported again, and all definitions of the file are checked again, since a
+# forbidden pattern on an unchanged line still stops the evaluation.
+
+WATCH_INTERVAL = 0.5
+
+# Returns the definitions of a line, the number of parseWhen names used and
+# whether the line failed to parse
+def parseWatchedLine(line):
+	global eqCounter
+	eqCounter = 0
+	try:
+		return parseLine(line), eqCounter, False
+	except StopEvaluation:
+		return [], eqCounter, True
+
+def watchFile(filename, io):
+	global DEFS, ARGUMENT_PATTERNS, eqCounter
+	base = len(DEFS)
+	functions = set(FUNCTIONS)
+	tables = dict(TABLES)
+	counter = eqCounter
+	cache = {}
+	mtime = None
+	while True:
+		try:
+			newMtime = os.stat(filename).st_mtime
+		except FileNotFoundError:
+			newMtime = None
+		if newMtime is not None and newMtime != mtime:
+			mtime = newMtime
+			numbered = list(readLines(filename))
+			lines = [line for number, line in numbered]
+			cache = {line: cache[line] if line in cache and not cache[line][2] else parseWatchedLine(line) for line in lines}
+			
+			oldFunctions = set(FUNCTIONS)
+			DEFS = DEFS[:base]
+			ARGUMENT_PATTERNS = None
+			VECTOR_FOLD.cache.clear()
+			FUNCTIONS.clear()
+			FUNCTIONS.update(functions)
+			TABLES.clear()
+			TABLES.update(tables)
+			CONSTANTS.clear()
+			eqCounter = counter
+			for number, line in numbered:
+				readPragma(line)
+				eqs, used, failed = cache[line]
+				for eq in renumberEqs(eqs, eqCounter):
+					if eq.op == "#olla":
+						addDefinition(eq, sourceLocation(filename, number))
+				eqCounter += used
+			
+			try:
+				if checkFunctionMatching(DEFS if FUNCTIONS != oldFunctions else DEFS[base:]):
+					printResult(io)
+			except StopEvaluation:
+				pass
+			sys.stdout.flush()
+		time.sleep(WATCH_INTERVAL)
 
 def evalExpression(string):
 	output = lexLine(string)
-	eq = parseEq(output, True)
+	eq = parseEq(TokenStream(output), True)
 	if not eq.query():
 		fatalError("Syntax error: expected expression, got declaration")
 	return evals(eq.left)
@@ -894,10 +2160,10 @@ def evalExpression(string):
 # In the restricted mode, pattern matching against functions is forbidden.
 # This function checks if there are any such forbidden patterns and
 # reports the errors.
-def checkFunctionMatching():
+def checkFunctionMatching(defs=None):
 	a = True
 	if not freeMode:
-		for defi in DEFS:
+		for defi in DEFS if defs is None else defs:
 			if isinstance(defi.left, CallTree):
 				if defi.left.head.containsFunctions():
 					functionMatchingError(defi.left)
@@ -912,6 +2178,62 @@ def checkFunctionMatching():
 def functionMatchingError(left):
 	sys.stderr.write("Error: pattern matching against functions is forbidden in the restricted mode (" + left.inflect("nimento") + ")\n")
 
+# Strictness analysis for the restricted mode. A path of argument indices is
+# strict for a function if every rule of the function has a pattern other
+# than a variable at that path. While the argument at a strict path is a call
+# of a function, no rule can match, so evals_ evaluates the arguments without
+# trying the rules. The arguments are evaluated exactly as before.
+
+# Maps the heads of functions to their strict paths, None when outdated
+STRICT = None
+
+def analyzeStrictness():
+	global STRICT
+	patterns = {}
+	for defi in DEFS:
+		if isinstance(defi.left, CallTree):
+			patterns.setdefault(defi.left.getHead(), []).append(defi.left)
+	STRICT = {}
+	if freeMode:
+		return
+	for head, lefts in patterns.items():
+		paths = []
+		for i in range(len(lefts[0].args)):
+			findStrictPaths([left.args[i] for left in lefts], (i,), paths)
+		if paths:
+			STRICT[head] = paths
+
+def findStrictPaths(patterns, path, paths):
+	if not all([isConstructorPattern(pattern) for pattern in patterns]):
+		return
+	paths += [path]
+	if all([isinstance(pattern, CallTree) for pattern in patterns]):
+		for i in range(min([len(pattern.args) for pattern in patterns])):
+			findStrictPaths([pattern.args[i] for pattern in patterns], path + (i,), paths)
+
+def isConstructorPattern(pattern):
+	if isinstance(pattern, CallTree):
+		return not isPatternVar(pattern.head) and pattern.getHead() not in FUNCTIONS
+	return not isPatternVar(pattern) and pattern not in FUNCTIONS
+
+def isFunctionCall(tree):
+	if isinstance(tree, CallTree):
+		return tree.getHead() in FUNCTIONS
+	return isinstance(tree, VarTree) and tree in FUNCTIONS
+
+# Tells whether the argument of a strict path of the call is a function call
+def awaitsArgument(tree):
+	for path in STRICT.get(tree.getHead(), []):
+		node = tree
+		for i in path:
+			if not isinstance(node, CallTree) or i >= len(node.args):
+				node = None
+				break
+			node = node.args[i]
+		if node is not None and isFunctionCall(node):
+			return True
+	return False
+
 # This class represents an optimization of a operator handling numbers
 # It allows together with NumTree efficient calculations even though
 # the standard library implementation of integers is very unefficient.
@@ -929,13 +2251,71 @@ class OptimizeOperator:
 	def optimize(self, tree):
 		return NumTree(self.fun(*[arg.num for arg in tree.args]))
 
+# This class represents an optimization of a function whose arguments are
+# not all numbers, eg. comparisons "a alempana b:tä tai c", where the
+# numbers are nested inside a conjunction. The functions receive the trees.
+class OptimizeCall:
+	def __init__(self, operator, opcase, argcases, ok, fun):
+		self.operator = operator
+		self.opcase = opcase
+		self.argcases = argcases
+		self.ok = ok
+		self.fun = fun
+	def match(self, tree):
+		if isinstance(tree, CallTree) and tree.headIs(self.operator, self.opcase, self.argcases):
+			return self.ok(*tree.args)
+	def optimize(self, tree):
+		return self.fun(*tree.args)
+
+def isNatural(tree):
+	return isinstance(tree, NumTree) and tree.num >= 0
+
+def isNumPair(tree):
+	return (isinstance(tree, CallTree) and tree.headIs("&ja", "", ("", ""))
+		and all([isinstance(arg, NumTree) for arg in tree.args]))
+
+def isComparison(tree):
+	return (isinstance(tree, CallTree) and tree.headIs("$alempi", "olento", ("", "osanto"))
+		and isNatural(tree.args[0]) and isNatural(tree.args[1]))
+
+def isSignTest(tree):
+	return (isinstance(tree, CallTree) and tree.headIs("$negatiivinen", "olento", ("", "osanto"))
+		and isinstance(tree.args[0], NumTree))
+
+# a jakovälivaiheena x:llä ja y:llä adds to a how many times y fits in x
+def divisionStepOk(a, x, y):
+	return x == 0 or (x < 0 and a > 0) or (x > 0 and y > 0)
+
+def divisionStep(a, x, y):
+	if x == 0:
+		return a
+	elif x < 0:
+		return a - 1
+	else:
+		return a + x // y
+
+# The std.suomi rules are defined only for natural numbers (except for the
+# negative results of subtraction), so the optimizations must not fire for
+# negative arguments where the rules would not reduce.
 OPTIMIZATIONS = [
-	OptimizeOperator("$seuraaja", "", ("omanto",), lambda x: True, lambda x: x + 1),
-	OptimizeOperator("$plus", "", ("", ""), lambda x, y: True, lambda x, y: x + y),
-	OptimizeOperator("$miinus", "", ("", ""), lambda x, y: x >= y, lambda x, y: x - y),
-	OptimizeOperator("$kerrottu", "olento", ("", "ulkoolento"), lambda x, y: True, lambda x, y: x * y),
-	OptimizeOperator("$jaettu", "olento", ("", "ulkoolento"), lambda x, y: y != 0, lambda x, y: x // y),
-	OptimizeOperator("$modulo", "", ("", ""), lambda x, y: True, lambda x, y: x % y)
+	OptimizeOperator("$seuraaja", "", ("omanto",), lambda x: x >= 0, lambda x: x + 1),
+	OptimizeOperator("$plus", "", ("", ""), lambda x, y: x >= 0 and y >= 0, lambda x, y: x + y),
+	OptimizeOperator("$miinus", "", ("", ""), lambda x, y: x >= 0 and y >= 0, lambda x, y: x - y),
+	OptimizeOperator("$vähennetty", "olento", ("", "sisaeronto"), lambda x, y: x >= 0 and y >= 0, lambda x, y: y - x),
+	OptimizeOperator("$negatiivinen", "olento", ("",), lambda x: x > 0, lambda x: -x),
+	OptimizeOperator("$kerrottu", "olento", ("", "ulkoolento"), lambda x, y: x >= 0 and y >= 0, lambda x, y: x * y),
+	OptimizeOperator("$jaettu", "olento", ("", "ulkoolento"), lambda x, y: x >= 0 and y > 0, lambda x, y: x // y),
+	OptimizeOperator("$korotettu", "olento", ("", "sisatulento"), lambda x, y: x >= 0 and y >= 0 and (x, y) != (0, 0), lambda x, y: x ** y),
+	OptimizeOperator("$modulo", "", ("", ""), lambda x, y: x >= 0 and (y > 0 or x == 0 and y == 0), lambda x, y: x % y if y else 0),
+	OptimizeCall("$jakovälivaihe", "olento", ("", "ulkoolento"),
+		lambda a, xy: isNatural(a) and isNumPair(xy) and divisionStepOk(a.num, *[arg.num for arg in xy.args]),
+		lambda a, xy: NumTree(divisionStep(a.num, *[arg.num for arg in xy.args]))),
+	OptimizeCall("&tai", "", ("", ""),
+		lambda test, c: isComparison(test),
+		lambda test, c: test.args[0] if test.args[0].num < test.args[1].num else c),
+	OptimizeCall("&tai", "", ("", ""),
+		lambda test, c: isSignTest(test),
+		lambda test, c: test.args[1] if test.args[0].num < 0 else c)
 ]
 
 class Builtin:
@@ -958,6 +2338,8 @@ def checkWorld(w):
 	if w.counter != worldCounter:
 		fatalError("Error: impossible time travel")
 	worldCounter += 1
+	if TRACERS:
+		trace("world", w.nextWorld())
 	return w.nextWorld()
 
 def createPair(output, w):
@@ -967,7 +2349,466 @@ def writeOutput(tree, w):
 	print(evals(tree).inflect("nimento"))
 	return createPair(VarTree("$tyhjyys"), w)
 
+# Returns the list as a ListTree if its spine is fully evaluated,
+# otherwise None. tyhjyys is returned as an empty list.
+def asList(tree):
+	if isinstance(tree, ListTree):
+		return tree
+	elements = []
+	while isinstance(tree, CallTree) and tree.headIs("$lisätty", "olento", ("", "sisatulento")):
+		elements += [tree.args[0]]
+		tree = tree.args[1]
+	if isinstance(tree, ListTree):
+		return ListTree(elements + tree.elements())
+	elif isinstance(tree, VarTree) and tree.name == "$tyhjyys":
+		return ListTree(elements) if elements else []
+	return None
+
+# Replaces list literals (lisätty chains ending in tyhjyys) with ListTrees
+def listLiterals(tree):
+	if not isinstance(tree, CallTree):
+		return tree
+	items = asList(tree)
+	if isinstance(items, ListTree):
+		return ListTree([listLiterals(e) for e in items.elements()])
+	return CallTree(tree.head, [listLiterals(arg) for arg in tree.args], tree.headInfl, tree.argInfls)
+
+def isListIndex(l, n, maximum):
+	items = asList(l)
+	return isNatural(n) and items is not None and n.num <= len(items) + maximum
+
+# The std.suomi rule "x plus nolla on x" precedes the list rules
+def isConcatenation(l, k):
+	return asList(l) is not None and not VarTree("$nolla").match(k)[0]
+
+def concatenate(l, k):
+	items = asList(l)
+	items2 = asList(k)
+	if len(items) == 0:
+		return k
+	elif items2 is None:
+		tail = k
+		for e in reversed(items.elements()):
+			tail = CallTree(VarTree("$lisätty"), [e, tail], "olento", ("", "sisatulento"))
+		return tail
+	elif len(items2) == 0:
+		return items
+	return ListTree(items.elements() + items2.elements())
+
+def isMembers(tree):
+	return (isinstance(tree, CallTree) and tree.headIs("@jäsen", "", ("omanto",))
+		and asList(tree.args[0]) is not None)
+
+def isMemberPair(tree):
+	return (isinstance(tree, CallTree) and tree.headIs("&ja", "", ("", ""))
+		and isMembers(tree.args[0]) and isMembers(tree.args[1])
+		and len(asList(tree.args[0].args[0])) == len(asList(tree.args[1].args[0])))
+
+# f sovellettuna l:n jäseniin, the elements are left unevaluated
+def mapList(f, members):
+	return mapItems(f, asList(members.args[0]))
+
+def mapItems(f, items):
+	if len(items) == 0:
+		return VarTree("$tyhjyys")
+	vector = mapVector(f, items)
+	if vector is not None:
+		return vector
+	return ListTree([mapCall(f, e) for e in items.elements()])
+
+def mapVector(f, items):
+	if isinstance(f, VarTree):
+		return vectorMap(CallTree(f, [HOLES[0]], "", ("omanto",)), [items])
+	return None
+
+def mapCall(f, e):
+	call = CallTree(None, None, "", ("omanto",))
+	call.head = f
+	call.args = [e]
+	return call
+
+# f sovellettuna l:n jäseniin ja k:n jäseniin
+def zipLists(f, members):
+	return zipItems(f, asList(members.args[0].args[0]), asList(members.args[1].args[0]))
+
+def zipItems(f, items, items2):
+	if len(items) == 0:
+		return VarTree("$tyhjyys")
+	vector = zipVector(f, items, items2)
+	if vector is not None:
+		return vector
+	return ListTree([zipCall(f, a, b) for a, b in zip(items.elements(), items2.elements())])
+
+def zipVector(f, items, items2):
+	return vectorMap(CallTree(VarTree("$kutsuttu"), [f, CallTree(VarTree("&ja"), list(HOLES), "", ("", ""))], "olento", ("", "ulkoolento")), [items, items2])
+
+def zipCall(f, a, b):
+	return CallTree(VarTree("$kutsuttu"), [f, CallTree(VarTree("&ja"), [a, b], "", ("", ""))], "olento", ("", "ulkoolento"))
+
+# List fusion: a map, zip or slice whose list is itself a map, zip or slice
+# of evaluated lists is computed in one pass over the innermost lists. Each
+# element of the result is built directly from the elements of the innermost
+# lists by nesting the calls of the mapped functions, and the slices only
+# shift the indices, so the intermediate lists are not built. Arithmetic maps
+# of the selected elements of numeric lists are still computed as one NumPy
+# operation like in the builtins. The result is the same list that the
+# builtins would give when applied one at a time, and lists that are not fully
+# evaluated are left to them and to the rules.
+fusion = True
+
+def isMemberCall(tree):
+	return isinstance(tree, CallTree) and tree.headIs("@jäsen", "", ("omanto",))
+
+# "map", "zip", "take" or "drop" for a call of a list operation, otherwise None
+def listOperation(tree):
+	if not isinstance(tree, CallTree):
+		return None
+	if tree.headIs("$sovellettu", "olento", ("", "sisatulento")):
+		members = tree.args[1]
+		if isMemberCall(members):
+			return "map"
+		if isinstance(members, CallTree) and members.headIs("&ja", "", ("", "")) and isMemberCall(members.args[0]) and isMemberCall(members.args[1]):
+			return "zip"
+	elif tree.headIs("$katkaistu", "olento", ("", "sisaeronto")) and isNatural(tree.args[1]):
+		return "take"
+	elif tree.headIs("$jatkettu", "olento", ("", "sisaeronto")) and isNatural(tree.args[1]):
+		return "drop"
+	return None
+
+def listArguments(tree, operation):
+	if operation == "map":
+		return [tree.args[1].args[0]]
+	elif operation == "zip":
+		return [tree.args[1].args[0].args[0], tree.args[1].args[1].args[0]]
+	return [tree.args[0]]
+
+# The nodes of a fused list. build(start, end) gives the elements from start to
+# end either as an evaluated list or as a function that builds the element at
+# an index counted from start.
+class FusedSource:
+	def __init__(self, items):
+		self.items = items
+		self.length = len(items)
+	def build(self, start, end):
+		return self.items.slice(start, end), None
+
+class FusedMap:
+	def __init__(self, f, l):
+		self.f = f
+		self.l = l
+		self.length = l.length
+	def build(self, start, end):
+		items, element = self.l.build(start, end)
+		if items is not None:
+			vector = mapVector(self.f, items)
+			if vector is not None:
+				return vector, None
+			element = items.get
+		return None, lambda i: mapCall(self.f, element(i))
+
+class FusedZip:
+	def __init__(self, f, l, k):
+		self.f = f
+		self.l = l
+		self.k = k
+		self.length = l.length
+	def build(self, start, end):
+		items, element = self.l.build(start, end)
+		items2, element2 = self.k.build(start, end)
+		if items is not None and items2 is not None:
+			vector = zipVector(self.f, items, items2)
+			if vector is not None:
+				return vector, None
+		element = items.get if items is not None else element
+		element2 = items2.get if items2 is not None else element2
+		return None, lambda i: zipCall(self.f, element(i), element2(i))
+
+class FusedSlice:
+	def __init__(self, l, start, length):
+		self.l = l
+		self.start = start
+		self.length = length
+	def build(self, start, end):
+		return self.l.build(self.start + start, self.start + end)
+
+# The fused list of an evaluated list or a fusable operation on evaluated
+# lists, otherwise None
+def fusedList(tree):
+	items = asList(tree)
+	if items is not None:
+		return FusedSource(items)
+	operation = listOperation(tree)
+	if operation is None:
+		return None
+	lists = [fusedList(l) for l in listArguments(tree, operation)]
+	if any([l is None for l in lists]) or len(set([l.length for l in lists])) > 1:
+		return None
+	n = lists[0].length
+	if operation == "map":
+		return FusedMap(tree.args[0], lists[0])
+	elif operation == "zip":
+		return FusedZip(tree.args[0], lists[0], lists[1])
+	k = tree.args[1].num
+	if k > n:
+		return None
+	elif operation == "take":
+		return FusedSlice(lists[0], 0, k)
+	return FusedSlice(lists[0], k, n - k)
+
+# The fused list found by match is kept for eval, which builds it
+class ListFusion:
+	def __init__(self):
+		self.operator = None
+		self.fused = (None, None)
+	def match(self, tree):
+		if not fusion or freeMode:
+			return False
+		operation = listOperation(tree)
+		if operation is None or not any([listOperation(l) for l in listArguments(tree, operation)]):
+			return False
+		self.fused = (tree, fusedList(tree))
+		return self.fused[1] is not None
+	def eval(self, tree):
+		fused = self.fused[1] if self.fused[0] is tree else fusedList(tree)
+		self.fused = (None, None)
+		if fused.length == 0:
+			return VarTree("$tyhjyys")
+		items, element = fused.build(0, fused.length)
+		if items is not None:
+			return items
+		return ListTree([element(i) for i in range(fused.length)])
+
+# Vectorized arithmetic: when every element of a mapped list is a number and
+# the mapped function immediately rewrites to an operator of OPTIMIZATIONS
+# (eg. "x:n tuplattu on x kerrottuna 2:lla"), the whole map is computed as
+# one NumPy operation. The operators are checked with the same conditions as
+# in OPTIMIZATIONS, so they fire exactly when the rules would be optimized.
+
+# Each operator has a condition, a function and the number of bits needed by
+# the result given the largest absolute values of the arguments.
+VECTOR_OPERATORS = {
+	"$seuraaja": (lambda x: (x >= 0).all(), lambda x: x + 1, lambda x: (x + 1).bit_length()),
+	"$plus": (lambda x, y: (x >= 0).all() and (y >= 0).all(), lambda x, y: x + y, lambda x, y: max(x, y).bit_length() + 1),
+	"$miinus": (lambda x, y: (x >= 0).all() and (y >= 0).all(), lambda x, y: x - y, lambda x, y: max(x, y).bit_length() + 1),
+	"$vähennetty": (lambda x, y: (x >= 0).all() and (y >= 0).all(), lambda x, y: y - x, lambda x, y: max(x, y).bit_length() + 1),
+	"$kerrottu": (lambda x, y: (x >= 0).all() and (y >= 0).all(), lambda x, y: x * y, lambda x, y: x.bit_length() + y.bit_length()),
+	"$jaettu": (lambda x, y: (x >= 0).all() and (y > 0).all(), lambda x, y: x // y, lambda x, y: x.bit_length()),
+	"$korotettu": (lambda x, y: (x >= 0).all() and (y >= 0).all() and not ((x == 0) & (y == 0)).any(),
+		lambda x, y: x ** y, lambda x, y: x.bit_length() * y),
+	"$modulo": (lambda x, y: (x >= 0).all() and ((y > 0) | ((x == 0) & (y == 0))).all(),
+		lambda x, y: numpy.where(y == 0, 0, x % numpy.where(y == 0, 1, y)), lambda x, y: x.bit_length())
+}
+
+# Placeholders for the elements of the first and second list in the shapes
+# given to vectorMap
+HOLES = [VarTree("$<alkio 1>"), VarTree("$<alkio 2>")]
+
+def holeIndex(tree):
+	for i, hole in enumerate(HOLES):
+		if tree is hole:
+			return i
+	return None
+
+def isPatternVar(tree):
+	return isinstance(tree, VarTree) and tree.pattern
+
+# Tells whether a pattern matches a shape for "always", "never" or only for
+# "maybe" some of the numbers that can fill the holes of the shape.
+def matchShape(pattern, shape, variables):
+	if isPatternVar(pattern):
+		if pattern.name in variables:
+			return "maybe"
+		variables[pattern.name] = shape
+		return "always"
+	if holeIndex(shape) is not None:
+		return "maybe"
+	if isinstance(pattern, CallTree) and isinstance(shape, CallTree):
+		if pattern.headInfl != shape.headInfl or pattern.argInfls != shape.argInfls or len(pattern.args) != len(shape.args):
+			return "never"
+		results = [matchShape(a, b, variables) for a, b in zip([pattern.head] + pattern.args, [shape.head] + shape.args)]
+		return "never" if "never" in results else "maybe" if "maybe" in results else "always"
+	if isinstance(pattern, CallTree) or isinstance(shape, CallTree):
+		return "never"
+	return "always" if pattern == shape else "never"
+
+# Finds the operator that a call of the given shape is rewritten to. The
+# arguments of the operator are returned as hole indices or as numbers. At
+# least one argument must be a hole, as an operation of numbers only would
+# give a single number instead of an array.
+def vectorOperation(shape):
+	for opt in OPTIMIZATIONS:
+		if isinstance(opt, OptimizeOperator) and shape.headIs(opt.operator, opt.opcase, opt.argcases):
+			args = [holeIndex(arg) for arg in shape.args]
+			if None in args:
+				return None
+			return opt.operator, args
+	for defi in DEFS:
+		variables = {}
+		result = matchShape(defi.left, shape, variables)
+		if result == "maybe":
+			return None
+		elif result == "always":
+			body = defi.right
+			if defi.where or not isinstance(body, CallTree) or not isinstance(body.head, VarTree) or body.head.name not in VECTOR_OPERATORS:
+				return None
+			opt = [opt for opt in OPTIMIZATIONS if isinstance(opt, OptimizeOperator) and opt.operator == body.head.name][0]
+			if not body.headIs(opt.operator, opt.opcase, opt.argcases):
+				return None
+			args = []
+			for arg in body.args:
+				if isPatternVar(arg) and holeIndex(variables.get(arg.name)) is not None:
+					args += [holeIndex(variables[arg.name])]
+				elif isinstance(arg, NumTree):
+					args += [("number", arg.num)]
+				else:
+					return None
+			if not any([isinstance(arg, int) for arg in args]):
+				return None
+			return opt.operator, args
+	return None
+
+def numArray(items):
+	if isinstance(items, NumListTree):
+		return items.array()
+	elements = items.elements()
+	if not all([isinstance(e, NumTree) for e in elements]):
+		return None
+	nums = [e.num for e in elements]
+	if not nums:
+		return None
+	if max(nums).bit_length() < 63 and min(nums) > -2**63:
+		return numpy.array(nums, dtype=numpy.int64)
+	return numpy.array(nums, dtype=object)
+
+def vectorMap(shape, lists):
+	if not vectorize:
+		return None
+	arrays = [numArray(items) for items in lists]
+	if any([a is None for a in arrays]):
+		return None
+	operation = vectorOperation(shape)
+	if operation is None:
+		return None
+	operator, args = operation
+	ok, fun, bits = VECTOR_OPERATORS[operator]
+	values = [arrays[arg] if isinstance(arg, int) else numpy.array(arg[1], dtype=object) for arg in args]
+	if not ok(*values):
+		return None
+	maxima = [max(abs(int(a.min())), abs(int(a.max()))) for a in values]
+	if bits(*maxima) < 63:
+		values = [a.astype(numpy.int64) for a in values]
+	else:
+		values = [a.astype(object) for a in values]
+	return NumListTree(fun(*values))
+
+# Folds of numeric lists, such as
+#   tyhjyyden summa on nolla
+#   a:n lisättynä b:hen summa on a plus b:n summa
+# are computed as one NumPy sum or product.
+# The folds are cached by the name of the function until definitions are
+# added or changed.
+class VectorFold:
+	def __init__(self):
+		self.operator = None
+		self.cache = {}
+	def fold(self, f):
+		if f.name not in self.cache:
+			self.cache[f.name] = vectorFold(f)
+		return self.cache[f.name]
+	def match(self, tree):
+		if not vectorize or not isinstance(tree, CallTree) or tree.headInfl != "" or tree.argInfls != ("omanto",):
+			return False
+		if not isinstance(tree.head, VarTree) or not isinstance(tree.args[0], ListTree):
+			return False
+		fold = self.fold(tree.head)
+		if fold is None:
+			return False
+		array = numArray(tree.args[0])
+		return array is not None and (array >= 0).all() and fold[1] >= 0
+	def eval(self, tree):
+		operator, base = self.fold(tree.head)
+		array = numArray(tree.args[0])
+		bits = max(abs(int(array.min())), abs(int(array.max())), base).bit_length()
+		if operator == "$plus":
+			if bits + len(array).bit_length() < 62:
+				return NumTree(base + int(array.astype(numpy.int64).sum()))
+			return NumTree(base + sum(array.tolist()))
+		else:
+			if bits * (len(array) + 1) < 63:
+				return NumTree(base * int(array.astype(numpy.int64).prod()))
+			product = base
+			for n in array.tolist():
+				product *= n
+			return NumTree(product)
+
+def vectorFold(f):
+	cons = CallTree(VarTree("$lisätty"), list(HOLES), "olento", ("", "sisatulento"))
+	step = firstRuleBody(CallTree(f, [cons], "", ("omanto",)))
+	base = firstRuleBody(CallTree(f, [VarTree("$tyhjyys")], "", ("omanto",)))
+	if step is None or base is None or not isinstance(base[0], NumTree):
+		return None
+	body, variables = step
+	if not isinstance(body, CallTree):
+		return None
+	for opt in OPTIMIZATIONS:
+		if isinstance(opt, OptimizeOperator) and opt.operator in ["$plus", "$kerrottu"] and body.headIs(opt.operator, opt.opcase, opt.argcases):
+			break
+	else:
+		return None
+	def isElement(arg):
+		return isPatternVar(arg) and variables.get(arg.name) is HOLES[0]
+	def isRecursion(arg):
+		return isinstance(arg, CallTree) and arg.headIs(f.name, "", ("omanto",)) and isPatternVar(arg.args[0]) and variables.get(arg.args[0].name) is HOLES[1]
+	if not any(map(isElement, body.args)) or not any(map(isRecursion, body.args)):
+		return None
+	return opt.operator, base[0].num
+
+# The body and the variables of the first rule that matches every call of
+# the given shape
+def firstRuleBody(shape):
+	for defi in DEFS:
+		variables = {}
+		result = matchShape(defi.left, shape, variables)
+		if result == "maybe":
+			return None
+		elif result == "always":
+			return (defi.right, variables) if not defi.where else None
+	return None
+
+VECTOR_FOLD = VectorFold()
+LIST_FUSION = ListFusion()
+
 BUILTINS = [
+	Builtin("$tutkittu", "olento", ("", "ulkoolento"),
+		lambda l, n: isListIndex(l, n, -1),
+		lambda l, n: asList(l).get(n.num)
+	),
+	Builtin("$katkaistu", "olento", ("", "sisaeronto"),
+		lambda l, n: isListIndex(l, n, 0),
+		lambda l, n: asList(l).slice(0, n.num) if n.num > 0 else VarTree("$tyhjyys")
+	),
+	Builtin("$jatkettu", "olento", ("", "sisaeronto"),
+		lambda l, n: isListIndex(l, n, 0),
+		lambda l, n: asList(l).slice(n.num, len(asList(l))) if n.num > 0 else l
+	),
+	Builtin("$plus", "", ("", ""),
+		isConcatenation,
+		concatenate
+	),
+	Builtin("$yhdistetty", "olento", ("", "sisatulento"),
+		isConcatenation,
+		concatenate
+	),
+	Builtin("$sovellettu", "olento", ("", "sisatulento"),
+		lambda f, members: isMembers(members),
+		mapList
+	),
+	Builtin("$sovellettu", "olento", ("", "sisatulento"),
+		lambda f, members: isMemberPair(members),
+		zipLists
+	),
+	VECTOR_FOLD,
+	LIST_FUSION,
 	Builtin("$luettu", "olento", ("", "sisaeronto"),
 		lambda l, w: isinstance(w, WorldTree),
 		lambda l, w: createPair(evalExpression(input(l.inflect("nimento") + "> ")), w)
@@ -978,12 +2819,159 @@ BUILTINS = [
 	)
 ]
 
+# Result cache: the values of queries are stored in a directory, keyed by a
+# hash of the interpreter version, the mode, all definitions and the query.
+# Each value is a gzipped JSON file of the term, where a name is a string, a
+# number is a number and a call is ["c", head, head case, argument cases,
+# arguments]. Files older than the maximum age are removed, and the least
+# recently used files are removed when the directory is larger than the
+# maximum size. The values of impure programs are never cached.
+class ResultCache:
+	def __init__(self, directory, maxSize, maxAge):
+		self.directory = directory
+		self.maxSize = maxSize
+		self.maxAge = maxAge
+		self.hits = 0
+		self.misses = 0
+		os.makedirs(directory, exist_ok=True)
+	def key(self, tree):
+		digest = hashlib.sha256()
+		digest.update(("%s %s %s %s %s\n" % (VERSION_STRING, magic, freeMode, impure, vectorize)).encode("utf-8"))
+		for defi in DEFS:
+			digest.update(("%s %s\n" % (defi.always, defi.str())).encode("utf-8"))
+		digest.update(("? " + tree.str()).encode("utf-8"))
+		return digest.hexdigest()
+	def path(self, key):
+		return os.path.join(self.directory, key + ".json.gz")
+	def load(self, key):
+		path = self.path(key)
+		try:
+			if time.time() - os.stat(path).st_mtime > self.maxAge:
+				os.remove(path)
+				return None
+			with gzip.open(path, "rt", encoding="utf-8") as file:
+				term = json.load(file)
+			# The modification time tells when the file was last used
+			os.utime(path)
+		except (OSError, ValueError, EOFError):
+			return None
+		return decodeTerm(term)
+	def store(self, key, result):
+		try:
+			term = encodeTerm(result, [], [0])
+		except UncacheableTerm:
+			return
+		try:
+			descriptor, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+			with os.fdopen(descriptor, "wb") as raw, gzip.open(raw, "wt", encoding="utf-8") as file:
+				json.dump(term, file, ensure_ascii=False, separators=(",", ":"))
+			os.replace(temporary, self.path(key))
+		except OSError as e:
+			sys.stderr.write("Warning: could not write to the result cache: " + str(e) + "\n")
+			return
+		self.evict()
+	def evict(self):
+		now = time.time()
+		files = []
+		for name in os.listdir(self.directory):
+			if name.endswith(".json.gz"):
+				try:
+					stat = os.stat(os.path.join(self.directory, name))
+				except OSError:
+					continue
+				files += [(stat.st_mtime, stat.st_size, name)]
+		files.sort()
+		total = sum([size for mtime, size, name in files])
+		for mtime, size, name in files:
+			if now - mtime <= self.maxAge and total <= self.maxSize:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except OSError:
+				pass
+			total -= size
+	def evals(self, tree):
+		key = self.key(tree)
+		result = self.load(key)
+		if result is not None:
+			self.hits += 1
+			return result
+		self.misses += 1
+		world = worldCounter
+		result = evals(tree)
+		# IO builtins were used if the world changed
+		if world == worldCounter:
+			self.store(key, result)
+		return result
+
+resultCache = None
+
+# Tracers would not see the evaluation of a cached value, so the cache is
+# not used while tracing. The followed copies of the constants are finished
+# only when the whole query has been evaluated, not after the nested
+# evaluations of the IO builtins.
+def evalsCached(tree):
+	try:
+		if resultCache is None or TRACERS:
+			return evals(tree)
+		return resultCache.evals(tree)
+	finally:
+		finishConstants()
+
+class UncacheableTerm(Exception):
+	pass
+
+MAX_CACHED_NODES = 1000000
+
+# Cyclic terms, worlds and terms with more than MAX_CACHED_NODES nodes
+# (counting shared nodes at each occurrence) are not cached
+def encodeTerm(tree, path, count):
+	count[0] += 1
+	if count[0] > MAX_CACHED_NODES or any([obj is tree for obj in path]):
+		raise UncacheableTerm()
+	if isinstance(tree, NumTree):
+		return tree.num
+	elif isinstance(tree, VarTree):
+		return tree.name if tree.alias is None else ["a", tree.name, tree.alias]
+	elif isinstance(tree, NumListTree):
+		return ["n", [int(n) for n in tree.array()]]
+	elif isinstance(tree, ListTree):
+		return ["l", [encodeTerm(e, path + [tree], count) for e in tree.elements()]]
+	elif isinstance(tree, CallTree):
+		return ["c", encodeTerm(tree.head, path + [tree], count), tree.headInfl, list(tree.argInfls),
+			[encodeTerm(arg, path + [tree], count) for arg in tree.args]]
+	raise UncacheableTerm()
+
+def decodeTerm(term):
+	if isinstance(term, int):
+		return NumTree(term)
+	elif isinstance(term, str):
+		return VarTree(term)
+	elif term[0] == "a":
+		return VarTree(term[1], term[2])
+	elif term[0] == "n":
+		return NumListTree(numArray(ListTree([NumTree(n) for n in term[1]])))
+	elif term[0] == "l":
+		return ListTree([decodeTerm(e) for e in term[1]])
+	return CallTree(decodeTerm(term[1]), [decodeTerm(arg) for arg in term[4]], term[2], tuple(term[3]))
+
+def resultTree(io):
+	if io:
+		return CallTree(VarTree("$tulos"), [WorldTree(worldCounter)], "", ("omanto",))
+	else:
+		return parseVar("$tulos")
+
+def printResult(io):
+	print(evalsCached(resultTree(io)).inflect("nimento"))
+
 debug = False
 visualize = False
 verbosity = 0
 magic = True
 freeMode = False
 impure = False
+jobs = 1
+vectorize = numpy is not None
 
 TAMPIO_VERSION = "1.8"
 INTERPRETER_VERSION = "2.5.1"
@@ -1003,11 +2991,31 @@ if __name__ == "__main__":
 	free.add_argument('-p', '--free-pure', help='enable pure free mode', action='store_true')
 	parser.add_argument('--io', help='evaluate "maailman tulos" instead of "tulos"', action='store_true')
 	parser.add_argument('--no-magic', help='disable all optimizations and builtins', action='store_true')
+	parser.add_argument('--no-vectorize', help='do not use NumPy for lists of numbers', action='store_true')
+	parser.add_argument('--no-fusion', help='do not fuse maps and slices of lists', action='store_true')
+	parser.add_argument('--no-jit', help='do not compile frequently used rules to Python', action='store_true')
+	parser.add_argument('--jit-threshold', help='compile a rule after it has been used N times (default: 100)', type=int, default=JIT_THRESHOLD, metavar='N')
+	parser.add_argument('--dump-jit', help='print the Python code of compiled rules', action='store_true')
+	parser.add_argument('-w', '--watch', help='re-evaluate the file whenever it changes', action='store_true')
+	parser.add_argument('-j', '--jobs', help='lex and parse source files in N worker processes', type=int, default=1, metavar='N')
+	parser.add_argument('--cache', help='store the values of queries in DIR and reuse them when the definitions are the same', type=str, metavar='DIR')
+	parser.add_argument('--cache-size', help='maximum size of the cache directory in megabytes (default 100)', type=float, default=100, metavar='MB')
+	parser.add_argument('--cache-age', help='remove cached values not used in DAYS days (default 30)', type=float, default=30, metavar='DAYS')
+	parser.add_argument('-t', '--table', help='store the results of calls of FUNCTION in the restricted mode, optionally in a table of SIZE results', type=str, action='append', default=[], metavar='FUNCTION[:SIZE]')
+	parser.add_argument('--table-size', help='default size of the tables (default 1000)', type=int, default=TABLE_SIZE, metavar='N')
 	
 	debugOptions = parser.add_argument_group('debug options')
 	debugOptions.add_argument('--debug', help='enable debug mode', action='store_true')
 	debugOptions.add_argument('-V', '--verbosity', help='verbosity level of debug information', action='count', default=0)
 	debugOptions.add_argument('--visualize', help='enable inflected debug mode', action='store_true')
+	debugOptions.add_argument('--profile', help='print the match attempts, rewrites and time of each rule at exit', action='store_true')
+	debugOptions.add_argument('--profile-json', help='also write the profile to FILE as JSON', type=str, metavar='FILE')
+	debugOptions.add_argument('--sample', help='sample the evaluation stack and write collapsed stacks to FILE at exit; SIGUSR1 toggles sampling', type=str, metavar='FILE')
+	debugOptions.add_argument('--sample-interval', help='sampling interval in milliseconds of CPU time (default 10)', type=float, default=10, metavar='MS')
+	debugOptions.add_argument('--memory', help='print the peak number of live term nodes and the nodes allocated by each rule at exit', action='store_true')
+	debugOptions.add_argument('--memory-interval', help='count the live term nodes every N evaluation steps (default 1)', type=int, default=1, metavar='N')
+	debugOptions.add_argument('--memory-json', help='also write the memory report to FILE as JSON', type=str, metavar='FILE')
+	debugOptions.add_argument('--trace', help='print the last N evaluation events when the evaluation stops on an error', type=int, metavar='N')
 	args = parser.parse_args()
 	
 	if args.version:
@@ -1020,18 +3028,63 @@ if __name__ == "__main__":
 	magic = not args.no_magic
 	verbosity = args.verbosity
 	visualize = args.visualize
+	jobs = args.jobs
+	vectorize = vectorize and magic and not args.no_vectorize
+	fusion = not args.no_fusion
+	jit = not args.no_jit
+	JIT_THRESHOLD = args.jit_threshold
+	dumpJit = args.dump_jit
+	TABLE_SIZE = args.table_size
+	for item in args.table:
+		name, colon, size = item.partition(":")
+		if colon and not size.isdigit():
+			parser.error("invalid table size: " + item)
+		tableFunction(name, int(size) if colon else None)
+	if args.table and freeMode:
+		sys.stderr.write("Warning: --table is only used in the restricted mode\n")
+	if args.cache and (impure or args.io):
+		sys.stderr.write("Warning: --cache is not used in the impure free mode or with --io\n")
+	elif args.cache:
+		resultCache = ResultCache(args.cache, args.cache_size * 1024 * 1024, args.cache_age * 24 * 60 * 60)
+	
+	if debug:
+		addTracer(DebugTracer(verbosity))
+	if visualize:
+		addTracer(VisualizeTracer())
+	if args.trace:
+		addTracer(RingTracer(args.trace))
+	if args.profile or args.profile_json:
+		profiler = Profiler()
+		addTracer(profiler)
+		atexit.register(profiler.report, args.profile_json)
+	if args.memory or args.memory_json:
+		memoryTracer = MemoryTracer(args.memory_interval)
+		addTracer(memoryTracer)
+		atexit.register(memoryTracer.report, args.memory_json)
+	if hasattr(signal, "SIGUSR2"):
+		signal.signal(signal.SIGUSR2, lambda signum, frame: printSnapshot())
+	if hasattr(signal, "SIGUSR1"):
+		sampler = Sampler(args.sample or "tampio-" + str(os.getpid()) + ".folded", args.sample_interval / 1000)
+		signal.signal(signal.SIGUSR1, sampler.toggle)
+		atexit.register(sampler.finish)
+		if args.sample:
+			sampler.start()
+	elif args.sample:
+		sys.stderr.write("Warning: --sample is not supported on this platform\n")
 	
 	evalFile(STD_LIB)
 	
 	if not checkFunctionMatching():
 		sys.exit(1)
 	
-	if args.filename:
+	if args.filename and args.watch:
+		try:
+			watchFile(args.filename, args.io)
+		except KeyboardInterrupt:
+			print()
+	elif args.filename:
 		evalFile(args.filename)
-		if args.io:
-			print(evals(CallTree(VarTree("$tulos"), [WorldTree(worldCounter)], "", ("omanto",))).inflect("nimento"))
-		else:
-			print(evals(parseVar("$tulos")).inflect("nimento"))
+		printResult(args.io)
 	else:
 		
 		histfile = os.path.join(os.path.expanduser("~"), ".tampio_history")
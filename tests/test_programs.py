@@ -0,0 +1,100 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Runs the programs in tests/ with the analyses of the fixture
+# benchmarks/voikko-fixture.json, so that libvoikko is not needed. The header
+# comment of each program gives the commands to run, indented by four spaces,
+# each followed by the lines it must print:
+#
+#     python3 suomi.py --no-magic tests/program.suomi
+#     "2" plus silmukka
+#
+# A command that reads the program from "<" runs it in the interactive
+# prompt, and the values of its queries are compared. The fixture is written
+# again with benchmarks/micro.py --record after the programs change.
+
+import os, sys, glob, shlex, subprocess
+import pytest
+
+TEST_DIR = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(TEST_DIR)
+FIXTURE = os.path.join(ROOT_DIR, "benchmarks", "voikko-fixture.json")
+COMMAND_PREFIX = "#     python3 suomi.py "
+
+def programFiles():
+	return sorted(glob.glob(os.path.join(TEST_DIR, "*.suomi")))
+
+# Returns the commands of the header of filename with their expected output
+def readCommands(filename):
+	commands = []
+	with open(filename, encoding="utf-8") as f:
+		for line in f:
+			line = line.rstrip("\n")
+			if not line.startswith("#"):
+				break
+			if line.startswith(COMMAND_PREFIX):
+				commands.append((shlex.split(line[len(COMMAND_PREFIX):]), []))
+			elif line.startswith("#     ") and commands:
+				commands[-1][1].append(line[len("#     "):])
+	return commands
+
+def run(args, stdin=None):
+	env = dict(os.environ)
+	env.pop("TAMPIO_VOIKKO_RECORD", None)
+	env["TAMPIO_VOIKKO_FIXTURE"] = FIXTURE
+	return subprocess.run([sys.executable, "suomi.py"] + args, cwd=ROOT_DIR, env=env, input=stdin,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=600)
+
+# Runs a command of a header and returns the printed values
+def runCommand(args):
+	if "<" in args:
+		index = args.index("<")
+		with open(os.path.join(ROOT_DIR, args[index+1]), encoding="utf-8") as f:
+			process = run(args[:index] + args[index+2:], f.read())
+		# The values follow the prompts
+		output = process.stdout.split(">>> ")[1:]
+	else:
+		process = run(args)
+		output = process.stdout.split("\n")
+	return process, [line.strip() for line in output if line.strip()]
+
+@pytest.mark.parametrize("filename", programFiles(), ids=os.path.basename)
+def test_program(filename):
+	commands = readCommands(filename)
+	assert commands, "no commands in the header of " + filename
+	for args, expected in commands:
+		process, output = runCommand(args)
+		assert output == expected, " ".join(args) + "\n" + process.stderr
+
+# The rewrites of each rule counted by --profile
+def profiledRewrites(stderr):
+	rewrites = {}
+	for line in stderr.split("\n"):
+		fields = line.split(None, 4)
+		if len(fields) == 5 and fields[1].isdigit() and fields[2].isdigit():
+			rewrites[fields[4]] = rewrites.get(fields[4], 0) + int(fields[2])
+	return rewrites
+
+# A constant that has been evaluated in a query is not evaluated again in a
+# later query
+@pytest.mark.parametrize("mode", [[], ["--no-magic"]], ids=["magic", "no-magic"])
+def test_remembered_constant(mode):
+	with open(os.path.join(TEST_DIR, "constants-repl.suomi"), encoding="utf-8") as f:
+		lines = [line for line in f if not line.startswith("#")]
+	once = run(["--profile"] + mode, "".join(lines[:-1]))
+	twice = run(["--profile"] + mode, "".join(lines))
+	rule = "x:n seuraajan seuraajan fibonacci"
+	assert profiledRewrites(once.stderr)[rule] == profiledRewrites(twice.stderr)[rule] > 0
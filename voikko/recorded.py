@@ -0,0 +1,72 @@
+# Tampio Interpreter
+# Copyright (C) 2017 Iikka Hauhio
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Stand-ins for voikko.libvoikko.Voikko. RecordingVoikko wraps a real
+# instance and saves the results of analyze and tokens to a JSON fixture.
+# RecordedVoikko replays a fixture without libvoikko or a morphological
+# dictionary.
+
+import os, json, atexit
+from voikko.libvoikko import Token, VoikkoException
+
+def loadFixture(filename, language):
+	if not os.path.exists(filename):
+		return {"language": language, "analyze": {}, "tokens": {}}
+	with open(filename, encoding="utf-8") as f:
+		fixture = json.load(f)
+	if fixture["language"] != language:
+		raise VoikkoException("Fixture %s was recorded for %s, not %s" % (filename, fixture["language"], language))
+	return fixture
+
+class RecordingVoikko:
+	def __init__(self, voikko, language, filename):
+		self.voikko = voikko
+		self.filename = filename
+		# Earlier recordings are kept, so that several runs can build one fixture
+		self.fixture = loadFixture(filename, language)
+		atexit.register(self.save)
+	def analyze(self, word):
+		analysisList = self.voikko.analyze(word)
+		self.fixture["analyze"][word] = analysisList
+		return analysisList
+	def tokens(self, text):
+		tokens = self.voikko.tokens(text)
+		self.fixture["tokens"][text] = [[token.tokenText, token.tokenType] for token in tokens]
+		return tokens
+	def save(self):
+		with open(self.filename, "w", encoding="utf-8") as f:
+			json.dump(self.fixture, f, ensure_ascii=False, indent=1, sort_keys=True)
+	def terminate(self):
+		self.voikko.terminate()
+
+class RecordedVoikko:
+	def __init__(self, language, filename):
+		if not os.path.exists(filename):
+			raise VoikkoException("Fixture %s does not exist" % filename)
+		fixture = loadFixture(filename, language)
+		self.analyses = fixture["analyze"]
+		self.tokenLists = fixture["tokens"]
+	def analyze(self, word):
+		if word not in self.analyses:
+			raise VoikkoException("No recorded analysis for '%s'" % word)
+		# The caller may modify the results
+		return [dict(analysis) for analysis in self.analyses[word]]
+	def tokens(self, text):
+		if text not in self.tokenLists:
+			raise VoikkoException("No recorded tokens for '%s'" % text)
+		return [Token(tokenText, tokenType) for tokenText, tokenType in self.tokenLists[text]]
+	def terminate(self):
+		pass